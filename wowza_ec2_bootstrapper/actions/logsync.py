@@ -1,10 +1,157 @@
 import os
+import json
+import hashlib
+import calendar
+import tempfile
+import threading
+import traceback
+import Queue
 
 import boto3
 import botocore
+import botocore.config
 
 from wowza_ec2_bootstrapper.actions import BaseAction
 
+def run_pool(func, items, concurrency, on_error=None):
+    """Call ``func`` for each of ``items`` from ``concurrency`` threads.
+    ``on_error(item, exc)`` is called for any exception raised
+    """
+    q = Queue.Queue(maxsize=concurrency * 4)
+    def worker():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                func(item)
+            except Exception as e:
+                if on_error is None:
+                    traceback.print_exc()
+                else:
+                    on_error(item, e)
+    threads = []
+    for i in range(concurrency):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    try:
+        for item in items:
+            q.put(item)
+    finally:
+        for t in threads:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+class MultipartState(object):
+    """Upload ids and completed parts of multipart uploads in progress,
+    saved to ``filename`` after every change so an interrupted upload can
+    be resumed
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.uploads = {}
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.uploads = json.loads(f.read())
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_fn = '.'.join([self.filename, 'tmp'])
+        with open(tmp_fn, 'wb') as f:
+            f.write(json.dumps(self.uploads))
+        os.rename(tmp_fn, self.filename)
+    def get(self, key):
+        with self.lock:
+            return self.uploads.get(key)
+    def set(self, key, upload):
+        with self.lock:
+            self.uploads[key] = upload
+            self.save()
+    def add_part(self, key, part_number, etag):
+        with self.lock:
+            self.uploads[key]['parts'][str(part_number)] = etag
+            self.save()
+    def remove(self, key):
+        with self.lock:
+            if self.uploads.pop(key, None) is not None:
+                self.save()
+
+def file_md5(filename, chunk_size=1024 * 1024):
+    h = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+class SyncManifest(object):
+    """Files synced by previous runs, keyed by S3 key
+
+    Each entry holds the local ``path``, ``size`` and ``mtime`` at the time
+    of the transfer, the ``md5`` of its contents and the ``etag`` of the
+    remote object.  Call :meth:`save` to write changes to ``filename``.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.entries = json.loads(f.read())
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp_fn = '.'.join([self.filename, 'tmp'])
+            with open(tmp_fn, 'wb') as f:
+                f.write(json.dumps(self.entries))
+            os.rename(tmp_fn, self.filename)
+            self.changed = False
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+    def add(self, key, local, etag, md5=None):
+        """Record ``local`` (an entry of :meth:`LogSyncBase.get_local_index`)
+        as in sync with the remote object ``etag``
+        """
+        if md5 is None:
+            md5 = file_md5(local['path'])
+        with self.lock:
+            self.entries[key] = {
+                'path':local['path'],
+                'size':local['size'],
+                'mtime':local['mtime'],
+                'md5':md5,
+                'etag':etag,
+            }
+            self.changed = True
+    def is_unchanged(self, key, local):
+        """Whether ``local`` still matches the entry for ``key``.  If only
+        the mtime differs the contents are hashed and compared
+        """
+        entry = self.get(key)
+        if entry is None or entry['size'] != local['size']:
+            return False
+        if entry['mtime'] == local['mtime']:
+            return True
+        if file_md5(local['path']) != entry['md5']:
+            return False
+        with self.lock:
+            entry['mtime'] = local['mtime']
+            self.changed = True
+        return True
+
 class LogSyncBase(BaseAction):
     action_fields = dict(
         bucket={
@@ -15,8 +162,53 @@ class LogSyncBase(BaseAction):
             'required':False, 
             'help':'Local path of log files. Leave blank to use system default', 
         }, 
+        concurrency={
+            'required':False, 
+            'help':'Number of files to transfer at once (default 8)', 
+        }, 
+        prefix={
+            'required':False, 
+            'help':'Key prefix for log files in the bucket', 
+        }, 
+        chunk_size={
+            'required':False, 
+            'help':'Bytes read from S3 at a time when downloading (default 1MB)', 
+        }, 
+        range_threshold={
+            'required':False, 
+            'help':'Objects at least this large are downloaded with parallel ranged GETs (default 64MB)', 
+        }, 
+        range_size={
+            'required':False, 
+            'help':'Size of each ranged GET (default 16MB)', 
+        }, 
+        range_concurrency={
+            'required':False, 
+            'help':'Ranged GETs in flight per object (default 4)', 
+        }, 
+        multipart_threshold={
+            'required':False, 
+            'help':'Files at least this large are sent as multipart uploads (default 64MB)', 
+        }, 
+        part_size={
+            'required':False, 
+            'help':'Size of each multipart upload part (default 16MB, minimum 5MB)', 
+        }, 
+        part_concurrency={
+            'required':False, 
+            'help':'Parts uploaded at once per file (default 4)', 
+        }, 
+        state_path={
+            'required':False, 
+            'help':'Directory for sync state. Defaults to ".logsync" in the log path', 
+        }, 
+        manifest={
+            'required':False, 
+            'help':'Keep a manifest of synced files so unchanged files are skipped without contacting S3 (default true)', 
+        }, 
     )
     __action_abstract = True
+    default_concurrency = 8
     @property
     def s3(self):
         s3 = getattr(self, '_s3', None)
@@ -24,17 +216,44 @@ class LogSyncBase(BaseAction):
             s3 = self._s3 = boto3.resource('s3')
         return s3
     @property
+    def s3_client(self):
+        """A single S3 client shared by all transfer threads (unlike
+        resources, clients are thread safe).  Its connection pool is sized
+        for every file transfer running its parts or ranges at once
+        """
+        client = getattr(self, '_s3_client', None)
+        if client is None:
+            client = self._s3_client = boto3.client(
+                's3', config=botocore.config.Config(
+                    max_pool_connections=self.max_pool_connections,
+                ),
+            )
+        return client
+    @property
+    def max_pool_connections(self):
+        per_file = max(
+            self.get_int_option('part_concurrency', 4),
+            self.get_int_option('range_concurrency', 4),
+            1,
+        )
+        return self.concurrency * per_file
+    @property
     def bucket(self):
         b = getattr(self, '_bucket', None)
         if b is None:
             b = self._bucket = self.get_bucket()
         return b
-    def get_bucket(self):
+    @property
+    def bucket_name(self):
         bname = self.kwargs.get('bucket')
-        if bname is not None:
-            return bname
-        bname = self.config.log_bucket_name
-        return self.s3.Bucket(bname)
+        if bname is None:
+            bname = self.config.log_bucket_name
+        return bname
+    def get_bucket(self):
+        return self.s3.Bucket(self.bucket_name)
+    @property
+    def concurrency(self):
+        return int(self.kwargs.get('concurrency') or self.default_concurrency)
     @property
     def log_path(self):
         p = getattr(self, '_log_path', None)
@@ -61,55 +280,424 @@ class LogSyncBase(BaseAction):
     def iter_local(self):
         p = self.log_path
         for fn in os.listdir(p):
-            yield os.path.join(p, fn)
+            fn = os.path.join(p, fn)
+            if not os.path.isfile(fn):
+                continue
+            yield fn
+    @property
+    def state_path(self):
+        p = self.kwargs.get('state_path')
+        if p is None:
+            p = os.path.join(self.log_path, '.logsync')
+        return p
+    @property
+    def multipart_state(self):
+        state = getattr(self, '_multipart_state', None)
+        if state is None:
+            fn = os.path.join(self.state_path, 'multipart.json')
+            state = self._multipart_state = MultipartState(fn)
+        return state
+    @property
+    def use_manifest(self):
+        value = self.kwargs.get('manifest', True)
+        if isinstance(value, basestring):
+            value = value.lower() not in ['0', 'false', 'no', 'off']
+        return bool(value)
+    @property
+    def manifest(self):
+        """The :class:`SyncManifest` in :attr:`state_path`, or ``None`` if
+        the ``manifest`` option is off
+        """
+        if not self.use_manifest:
+            return None
+        manifest = getattr(self, '_manifest', None)
+        if manifest is None:
+            fn = os.path.join(self.state_path, 'manifest.json')
+            manifest = self._manifest = SyncManifest(fn)
+        return manifest
+    @property
+    def prefix(self):
+        return self.kwargs.get('prefix') or ''
+    def get_key(self, filename):
+        return ''.join([self.prefix, os.path.basename(filename)])
+    def get_local_index(self):
+        """Map the name of each local log file to its ``path``, ``size``
+        and ``mtime``
+        """
+        index = {}
+        for fn in self.iter_local():
+            index[os.path.basename(fn)] = self.get_local_entry(fn)
+        return index
+    def get_local_entry(self, filename):
+        st = os.stat(filename)
+        return {
+            'path':filename,
+            'size':st.st_size,
+            'mtime':st.st_mtime,
+        }
+    def get_remote_index(self):
+        """Map the name (key without :attr:`prefix`) of each object under
+        :attr:`prefix` to its ``key``, ``size``, ``etag`` and
+        ``last_modified`` using paginated listings (one request per
+        thousand keys)
+        """
+        index = {}
+        prefix = self.prefix
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(prefix):]
+                if not name or '/' in name:
+                    continue
+                index[name] = {
+                    'key':obj['Key'],
+                    'size':obj['Size'],
+                    'etag':obj['ETag'].strip('"'),
+                    'last_modified':calendar.timegm(obj['LastModified'].utctimetuple()),
+                }
+        return index
+    def needs_upload(self, name, local, remote, entry=None):
+        if entry is not None:
+            # synced before and changed since
+            return True
+        if remote is None:
+            return True
+        if name.endswith('.log'):
+            return False
+        if local['size'] != remote['size']:
+            return True
+        # S3 only keeps whole seconds
+        return int(local['mtime']) > remote['last_modified']
+    def needs_download(self, name, local, remote, entry=None):
+        if local is None:
+            return True
+        if entry is not None and entry['etag'] != remote['etag']:
+            return True
+        if not name.endswith('.log'):
+            return False
+        return local['size'] != remote['size']
+    def get_uploads(self, local_index=None, remote_index=None):
+        """Get the paths of local files to upload.  Files unchanged since
+        they were recorded in the :attr:`manifest` are skipped without
+        contacting S3 and the remote index is only listed if any are left
+        """
+        if local_index is None:
+            local_index = self.get_local_index()
+        manifest = self.manifest
+        if manifest is not None:
+            local_index = {
+                name:local for name, local in local_index.items()
+                if not manifest.is_unchanged(self.get_key(name), local)
+            }
+            if not len(local_index):
+                return []
+        if remote_index is None:
+            remote_index = self.get_remote_index()
+        uploads = []
+        for name, local in sorted(local_index.items()):
+            key = self.get_key(name)
+            entry = None if manifest is None else manifest.get(key)
+            remote = remote_index.get(name)
+            if self.needs_upload(name, local, remote, entry):
+                uploads.append(local['path'])
+            elif manifest is not None:
+                manifest.add(key, local, remote['etag'])
+        return uploads
+    def get_downloads(self, local_index=None, remote_index=None):
+        if local_index is None:
+            local_index = self.get_local_index()
+        if remote_index is None:
+            remote_index = self.get_remote_index()
+        manifest = self.manifest
+        downloads = []
+        for name, remote in sorted(remote_index.items()):
+            local = local_index.get(name)
+            entry = None if manifest is None else manifest.get(remote['key'])
+            if entry is not None and local is not None:
+                if entry['etag'] == remote['etag'] and manifest.is_unchanged(remote['key'], local):
+                    continue
+            if self.needs_download(name, local, remote, entry):
+                downloads.append(os.path.join(self.log_path, name))
+            elif manifest is not None and local is not None:
+                manifest.add(remote['key'], local, remote['etag'])
+        return downloads
     def iter_remote(self):
-        return self.bucket.objects.all()
+        return self.bucket.objects.filter(Prefix=self.prefix)
     def get_remote_object(self, filename):
-        keyname = os.path.basename(filename)
-        return self.s3.Object(self.bucket.name, keyname)
+        return self.s3.Object(self.bucket_name, self.get_key(filename))
     def remote_exists(self, filename=None, obj=None):
-        if obj is None:
-            obj = self.get_remote_object(filename)
         exists = True
         try:
-            obj.load()
+            if obj is not None:
+                obj.load()
+            else:
+                self.s3_client.head_object(
+                    Bucket=self.bucket_name,
+                    Key=self.get_key(filename),
+                )
         except botocore.exceptions.ClientError:
             exists = False
         return exists
-    def get_remote(self, filename):
-        object = self.get_remote_object(filename)
-        r = object.get()
-        data = r['Body'].read()
-        ## TODO: handle permissions/owner
-        with open(filename, 'wb') as f:
-            f.write(data)
+    def get_int_option(self, name, default):
+        value = self.kwargs.get(name)
+        if value is None:
+            return default
+        return int(value)
+    def get_remote(self, filename, size=None):
+        """Download to a temporary file next to ``filename`` in fixed size
+        chunks, then rename it into place.  Objects of ``range_threshold``
+        bytes or more are fetched with concurrent ranged GETs.  ``size`` may
+        be given (from the remote index) to avoid a HEAD request
+        """
+        key = self.get_key(filename)
+        threshold = self.get_int_option('range_threshold', 64 * 1024 * 1024)
+        range_concurrency = self.get_int_option('range_concurrency', 4)
+        if size is None and range_concurrency > 1:
+            r = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+            size = r['ContentLength']
+        dirname, basename = os.path.split(filename)
+        fd, tmp_fn = tempfile.mkstemp(prefix='.%s.' % (basename), dir=dirname or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if size is not None and size >= threshold and range_concurrency > 1:
+                    f.truncate(size)
+                    f.close()
+                    self.get_remote_ranges(key, tmp_fn, size)
+                else:
+                    self.get_remote_stream(key, f)
+            ## TODO: handle permissions/owner
+            os.chmod(tmp_fn, 0o644)
+            os.rename(tmp_fn, filename)
+        except:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            raise
+    def copy_body(self, r, f):
+        chunk_size = self.get_int_option('chunk_size', 1024 * 1024)
+        body = r['Body']
+        count = 0
+        try:
+            while True:
+                data = body.read(chunk_size)
+                if not data:
+                    break
+                f.write(data)
+                count += len(data)
+        finally:
+            body.close()
+        if count != r['ContentLength']:
+            raise IOError('Expected %s bytes, received %s' % (r['ContentLength'], count))
+        return count
+    def get_remote_stream(self, key, f):
+        r = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+        return self.copy_body(r, f)
+    def get_remote_ranges(self, key, filename, size):
+        range_size = self.get_int_option('range_size', 16 * 1024 * 1024)
+        ranges = [(start, min(start + range_size, size) - 1) for start in xrange(0, size, range_size)]
+        errors = []
+        def get_range(byte_range):
+            if len(errors):
+                return
+            r = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Range='bytes=%d-%d' % byte_range,
+            )
+            with open(filename, 'r+b') as f:
+                f.seek(byte_range[0])
+                self.copy_body(r, f)
+        def on_error(byte_range, exc):
+            errors.append(exc)
+        run_pool(get_range, ranges, self.get_int_option('range_concurrency', 4), on_error)
+        if len(errors):
+            raise errors[0]
     def put_remote(self, filename):
-        keyname = os.path.basename(filename)
-        data = open(filename, 'rb')
-        self.bucket.put_object(
-            Key=keyname, 
-            Body=data, 
-            ContentType='text/plain', 
+        threshold = self.get_int_option('multipart_threshold', 64 * 1024 * 1024)
+        if os.path.getsize(filename) >= threshold:
+            return self.put_remote_multipart(filename)
+        keyname = self.get_key(filename)
+        with open(filename, 'rb') as data:
+            r = self.s3_client.put_object(
+                Bucket=self.bucket_name, 
+                Key=keyname, 
+                Body=data, 
+                ContentType='text/plain', 
+            )
+        return r['ETag'].strip('"')
+    def get_multipart_upload(self, key, filename):
+        """Get the saved state of an upload of ``filename`` to resume, or
+        start a new one.  Saved uploads for a different version of the file
+        are aborted
+        """
+        st = os.stat(filename)
+        part_size = max(self.get_int_option('part_size', 16 * 1024 * 1024), 5 * 1024 * 1024)
+        client = self.s3_client
+        upload = self.multipart_state.get(key)
+        if upload is not None:
+            current = (
+                upload['size'] == st.st_size and
+                upload['mtime'] == st.st_mtime and
+                upload['part_size'] == part_size
+            )
+            try:
+                if not current:
+                    client.abort_multipart_upload(
+                        Bucket=self.bucket_name, Key=key, UploadId=upload['upload_id'],
+                    )
+                    upload = None
+                else:
+                    # the parts S3 has are authoritative
+                    r = client.list_parts(
+                        Bucket=self.bucket_name, Key=key, UploadId=upload['upload_id'],
+                    )
+                    upload['parts'] = {
+                        str(p['PartNumber']):p['ETag'] for p in r.get('Parts', [])
+                    }
+            except botocore.exceptions.ClientError:
+                upload = None
+        if upload is None:
+            r = client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=key, ContentType='text/plain',
+            )
+            upload = {
+                'upload_id':r['UploadId'],
+                'size':st.st_size,
+                'mtime':st.st_mtime,
+                'part_size':part_size,
+                'parts':{},
+            }
+        self.multipart_state.set(key, upload)
+        return upload
+    def put_remote_multipart(self, filename):
+        """Upload ``filename`` in ``part_size`` parts, ``part_concurrency``
+        at a time.  Completed parts are recorded in :attr:`multipart_state`
+        so a failed or interrupted upload continues from where it stopped on
+        the next run
+        """
+        key = self.get_key(filename)
+        upload = self.get_multipart_upload(key, filename)
+        upload_id = upload['upload_id']
+        part_size = upload['part_size']
+        num_parts = max((upload['size'] + part_size - 1) // part_size, 1)
+        pending = [
+            n for n in xrange(1, num_parts + 1) if str(n) not in upload['parts']
+        ]
+        errors = []
+        def put_part(part_number):
+            if len(errors):
+                return
+            with open(filename, 'rb') as f:
+                f.seek((part_number - 1) * part_size)
+                data = f.read(part_size)
+            r = self.s3_client.upload_part(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+            self.multipart_state.add_part(key, part_number, r['ETag'])
+        def on_error(part_number, exc):
+            errors.append(exc)
+        run_pool(put_part, pending, self.get_int_option('part_concurrency', 4), on_error)
+        if len(errors):
+            raise errors[0]
+        parts = self.multipart_state.get(key)['parts']
+        r = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts':[
+                {'PartNumber':int(n), 'ETag':etag}
+                for n, etag in sorted(parts.items(), key=lambda i: int(i[0]))
+            ]},
         )
-    
+        self.multipart_state.remove(key)
+        return r['ETag'].strip('"')
+    def run_transfers(self, func, items, result=None):
+        """Call ``func`` for each of ``items`` from a pool of
+        :attr:`concurrency` threads
+
+        ``func`` returns ``True`` if the item was transferred or ``False``
+        if it was skipped.  Exceptions are recorded per item in the returned
+        :class:`SyncResult` rather than stopping the other transfers.
+        """
+        if result is None:
+            result = SyncResult()
+        # create the shared client and state before any threads need them
+        self.s3_client
+        self.multipart_state
+        def transfer(item):
+            if func(item):
+                result.add_transferred(item)
+            else:
+                result.add_skipped(item)
+        def on_error(item, exc):
+            traceback.print_exc()
+            result.add_failed(item, exc)
+        run_pool(transfer, items, self.concurrency, on_error)
+        return result
+
+class SyncResult(object):
+    """Outcome of a sync run.  Evaluates as ``True`` if no transfers failed
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transferred = []
+        self.skipped = []
+        self.failed = {}
+    def add_transferred(self, item):
+        with self.lock:
+            self.transferred.append(item)
+    def add_skipped(self, item):
+        with self.lock:
+            self.skipped.append(item)
+    def add_failed(self, item, exc):
+        with self.lock:
+            self.failed[item] = '%s: %s' % (exc.__class__.__name__, exc)
+    def __nonzero__(self):
+        return not len(self.failed)
+    def __repr__(self):
+        return '<SyncResult: %d transferred, %d skipped, %d failed>' % (
+            len(self.transferred), len(self.skipped), len(self.failed),
+        )
+
 class LogSyncUp(LogSyncBase):
     def do_action(self, **kwargs):
-        for local_fn in self.iter_local():
-            obj = self.get_remote_object(local_fn)
-            if self.remote_exists(obj=obj):
-                if local_fn.endswith('.log'):
-                    continue
-            self.put_remote(local_fn)
-        return True
+        manifest = self.manifest
+        def upload(local_fn):
+            # stat and hash before sending so later writes are seen as changes
+            local = self.get_local_entry(local_fn)
+            md5 = None if manifest is None else file_md5(local_fn)
+            etag = self.put_remote(local_fn)
+            if manifest is not None:
+                manifest.add(self.get_key(local_fn), local, etag, md5)
+            return True
+        try:
+            result = self.sync_result = self.run_transfers(upload, self.get_uploads())
+        finally:
+            if manifest is not None:
+                manifest.save()
+        for fn, error in sorted(result.failed.items()):
+            print 'upload failed for %s (%s)' % (fn, error)
+        return result
         
 class LogSyncDown(LogSyncBase):
     def do_action(self, **kwargs):
-        p = self.log_path
-        for obj in self.iter_remote():
-            local_fn = os.path.join(p, obj.key)
-            if os.path.exists(local_fn):
-                if not local_fn.endswith('.log'):
-                    continue
-            self.get_remote(local_fn)
-        return True
-        
+        manifest = self.manifest
+        remote_index = self.get_remote_index()
+        def download(local_fn):
+            remote = remote_index[os.path.basename(local_fn)]
+            self.get_remote(local_fn, remote['size'])
+            if manifest is not None:
+                manifest.add(remote['key'], self.get_local_entry(local_fn), remote['etag'])
+            return True
+        try:
+            downloads = self.get_downloads(remote_index=remote_index)
+            result = self.sync_result = self.run_transfers(download, downloads)
+        finally:
+            if manifest is not None:
+                manifest.save()
+        for fn, error in sorted(result.failed.items()):
+            print 'download failed for %s (%s)' % (fn, error)
+        return result
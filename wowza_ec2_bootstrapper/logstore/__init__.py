@@ -0,0 +1,40 @@
+import heapq
+
+from records import (
+    get_record_class, record_to_dict, RecordParser,
+    build_field_filters, match_fields,
+)
+from schema import SchemaRegistry
+from journal import Journal, format_raw_entries, parse_raw_entry
+from base import BaseStore
+from tinydb_store import TinyDBStore
+from segment import SegmentStore
+from retention import RetentionPolicy, RetentionTask, AGGREGATE_FIELDS
+
+def build_store(**kwargs):
+    return BaseStore.create(**kwargs)
+
+def get_shard_filename(filename, shard):
+    return '%s.shard%d' % (filename, shard)
+
+def merge_stores(sources, dest, batch_size=1000):
+    """Copy entries from each store in ``sources`` into ``dest`` ordered by
+    timestamp.  Each source is assumed to already be in timestamp order.
+    """
+    def iter_source(i, store):
+        for record in store.iter_records():
+            yield record.timestamp, i, record
+    iters = [iter_source(i, store) for i, store in enumerate(sources)]
+    batch = []
+    count = 0
+    for ts, i, record in heapq.merge(*iters):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            dest.write_entries(batch)
+            count += len(batch)
+            batch = []
+    if len(batch):
+        dest.write_entries(batch)
+        count += len(batch)
+    dest.close()
+    return count
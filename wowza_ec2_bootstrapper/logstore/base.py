@@ -0,0 +1,163 @@
+import os
+import time
+import threading
+
+from wowza_ec2_bootstrapper.logstore.records import (
+    record_to_dict, build_field_filters, match_fields,
+)
+from wowza_ec2_bootstrapper.logstore.schema import SchemaRegistry
+
+
+class BaseStore(object):
+    """Base class for access log storage backends
+
+    Subclasses are located by :attr:`store_name` when a :class:`DbLogger` is
+    created with the ``storage`` keyword argument.  Entries are written in
+    batches of :mod:`records` tuples and flushed to disk once
+    ``flush_count`` entries are pending or ``flush_interval`` seconds have
+    passed since the last flush.
+
+    Writes, flushes and deletions hold :attr:`lock` so maintenance such as
+    :mod:`retention` can run from another thread.  If
+    :attr:`concurrent_reads` is ``False`` readers in other threads must
+    hold it as well.
+
+    Each record layout written is registered in :attr:`schemas` (see
+    :class:`SchemaRegistry`) so backends can store its version with the
+    data.
+    """
+    __store_abstract = True
+    store_name = None
+    default_filename = None
+    concurrent_reads = False
+    def __init__(self, **kwargs):
+        filename = kwargs.get('filename')
+        if filename is None:
+            filename = self.default_filename
+        self.filename = os.path.expanduser(filename)
+        self.field_names = kwargs.get('field_names')
+        self.flush_count = int(kwargs.get('flush_count', 1000))
+        self.flush_interval = float(kwargs.get('flush_interval', 5.))
+        self._unflushed = 0
+        self._last_flush = time.time()
+        self.lock = threading.RLock()
+        self._schemas = None
+    @classmethod
+    def get_store_class(cls, **kwargs):
+        store_name = kwargs.get('storage')
+        if store_name is None:
+            store_name = 'tinydb'
+        if isinstance(store_name, BaseStore):
+            return store_name.__class__
+        def find_class(base_cls):
+            if getattr(base_cls, 'store_name', None) == store_name:
+                return base_cls
+            if base_cls.__name__ == store_name:
+                return base_cls
+            for _cls in base_cls.__subclasses__():
+                r = find_class(_cls)
+                if r is not None:
+                    return r
+            return None
+        store_cls = find_class(cls)
+        if store_cls is None:
+            raise Exception('Could not locate storage backend %s' % (store_name))
+        return store_cls
+    @classmethod
+    def create(cls, **kwargs):
+        store = kwargs.get('storage')
+        if isinstance(store, BaseStore):
+            return store
+        store_cls = cls.get_store_class(**kwargs)
+        return store_cls(**kwargs)
+    @classmethod
+    def get_filename(cls, **kwargs):
+        filename = kwargs.get('filename')
+        if filename is None:
+            filename = cls.get_store_class(**kwargs).default_filename
+        return os.path.expanduser(filename)
+    @property
+    def schema_filename(self):
+        return '.'.join([self.filename, 'schemas'])
+    @property
+    def schemas(self):
+        if self._schemas is None:
+            self._schemas = SchemaRegistry(self.schema_filename)
+        return self._schemas
+    def get_schema_version(self, fields):
+        return self.schemas.get_version(fields)
+    @property
+    def flush_timeout(self):
+        """Maximum time the writer thread should wait before calling
+        :meth:`check_flush`.  ``None`` if the backend does not buffer writes
+        """
+        return self.flush_interval
+    @property
+    def pending_count(self):
+        """Number of written entries that have not yet been flushed
+        """
+        return self._unflushed
+    def open(self):
+        pass
+    def close(self):
+        self.flush()
+    def write_entries(self, records):
+        with self.lock:
+            self.open()
+            self._write_entries(records)
+            self._unflushed += len(records)
+            self.check_flush()
+    def _write_entries(self, records):
+        raise NotImplementedError('must be defined in subclass')
+    def flush(self):
+        with self.lock:
+            if self._unflushed:
+                self._flush()
+            self._unflushed = 0
+            self._last_flush = time.time()
+    def _flush(self):
+        pass
+    def check_flush(self, now=None):
+        if not self._unflushed:
+            return False
+        if now is None:
+            now = time.time()
+        if self._unflushed >= self.flush_count:
+            self.flush()
+        elif now - self._last_flush >= self.flush_interval:
+            self.flush()
+        else:
+            return False
+        return True
+    def iter_records(self, start=None, end=None):
+        """Yield stored records, optionally limited to those with a
+        ``timestamp`` in the range [``start``, ``end``)
+        """
+        raise NotImplementedError('must be defined in subclass')
+    def get_retention_cutoff(self, ts):
+        """Round ``ts`` down to a time :meth:`remove_before` can delete up to
+        exactly
+        """
+        return ts
+    def remove_before(self, ts):
+        """Delete stored records with a ``timestamp`` before ``ts``
+        """
+        raise NotImplementedError('must be defined in subclass')
+    def search(self, start=None, end=None, **filters):
+        """Yield records in the range [``start``, ``end``) whose fields
+        match ``filters`` (field names mapped to a value or a list of
+        accepted values).  Backends may override this to skip decoding
+        records that cannot match
+        """
+        field_filters = build_field_filters(filters)
+        for record in self.iter_records(start, end):
+            if match_fields(record, field_filters):
+                yield record
+    def iter_entries(self, start=None, end=None):
+        for record in self.iter_records(start, end):
+            yield record_to_dict(record)
+    def remove(self):
+        self.close()
+        for fn in [self.filename, self.schema_filename]:
+            if os.path.exists(fn):
+                os.remove(fn)
@@ -0,0 +1,177 @@
+import os
+import time
+import errno
+import threading
+
+def format_raw_entries(entries):
+    """Serialize ``(line, ts)`` tuples as they were received, one per line
+    """
+    return ''.join(['%r\t%s\n' % (ts, line.rstrip('\n')) for line, ts in entries])
+
+def parse_raw_entry(s):
+    ts, line = s.rstrip('\n').split('\t', 1)
+    return line, float(ts)
+
+class Journal(object):
+    """Write-ahead journal for received log lines
+
+    Entries are appended to sequentially numbered journal files in
+    ``dirname`` before they are queued for storage.  The journal is synced
+    to disk at most every ``sync_interval`` seconds.  Once the storage
+    writer reports (via :meth:`checkpoint`) that every entry up to a
+    sequence number is safely stored, journal files holding only those
+    entries are removed.  Anything after the last checkpoint is returned
+    by :meth:`iter_uncommitted` when the journal is opened again.
+    """
+    file_prefix = 'journal-'
+    file_ext = '.log'
+    def __init__(self, dirname, **kwargs):
+        self.dirname = os.path.expanduser(dirname)
+        self.sync_interval = float(kwargs.get('sync_interval', 1.))
+        self.file_size = int(kwargs.get('file_size', 16 * 1024 * 1024))
+        self.lock = threading.Lock()
+        self._fh = None
+        self._files = []
+        self._file_start = None
+        self._file_bytes = 0
+        self._last_sync = time.time()
+        self._need_sync = False
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        self.committed_seq = self.read_checkpoint()
+        self.seq = self.committed_seq
+        for start_seq, fn in self.iter_files():
+            n = self.repair_file(fn)
+            if not n:
+                os.remove(fn)
+                continue
+            self._files.append((start_seq, start_seq + n - 1, fn))
+            self.seq = max(self.seq, start_seq + n - 1)
+    def repair_file(self, fn):
+        """Truncate a partial line left by a crash mid-write and return the
+        number of complete entries in ``fn``
+        """
+        n = 0
+        size = 0
+        with open(fn, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                n += 1
+                size += len(line)
+        if size != os.path.getsize(fn):
+            with open(fn, 'r+b') as f:
+                f.truncate(size)
+        return n
+    @property
+    def checkpoint_filename(self):
+        return os.path.join(self.dirname, 'checkpoint')
+    def read_checkpoint(self):
+        fn = self.checkpoint_filename
+        if not os.path.exists(fn):
+            return 0
+        with open(fn, 'r') as f:
+            return int(f.read().strip() or 0)
+    def write_checkpoint(self, seq):
+        fn = self.checkpoint_filename
+        tmp_fn = '.'.join([fn, 'tmp'])
+        with open(tmp_fn, 'w') as f:
+            f.write(str(seq))
+        os.rename(tmp_fn, fn)
+    def iter_files(self):
+        for fn in sorted(os.listdir(self.dirname)):
+            if not fn.startswith(self.file_prefix):
+                continue
+            if not fn.endswith(self.file_ext):
+                continue
+            start_seq = int(fn[len(self.file_prefix):-len(self.file_ext)])
+            yield start_seq, os.path.join(self.dirname, fn)
+    def iter_uncommitted(self):
+        """Yield ``(seq, line, ts)`` for every entry after the last checkpoint
+        """
+        committed = self.committed_seq
+        for start_seq, last_seq, fn in self._files:
+            if last_seq <= committed:
+                continue
+            with open(fn, 'rb') as f:
+                seq = start_seq
+                for s in f:
+                    if not s.endswith('\n'):
+                        break
+                    if seq > committed:
+                        line, ts = parse_raw_entry(s)
+                        yield seq, line, ts
+                    seq += 1
+    def open_file(self):
+        start_seq = self.seq + 1
+        fn = '%s%016d%s' % (self.file_prefix, start_seq, self.file_ext)
+        fn = os.path.join(self.dirname, fn)
+        self._fh = open(fn, 'ab')
+        self._file_start = start_seq
+        self._file_bytes = 0
+        if not len(self._files) or self._files[-1][2] != fn:
+            self._files.append((start_seq, self.seq, fn))
+    def close_file(self):
+        fh = self._fh
+        if fh is None:
+            return
+        self._fh = None
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+    def append(self, entries):
+        if not len(entries):
+            return
+        data = format_raw_entries(entries)
+        with self.lock:
+            if self._fh is None or self._file_bytes >= self.file_size:
+                self.close_file()
+                self.open_file()
+            self._fh.write(data)
+            self._file_bytes += len(data)
+            self.seq += len(entries)
+            start_seq, last_seq, fn = self._files[-1]
+            self._files[-1] = (start_seq, self.seq, fn)
+            self._need_sync = True
+            if time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+    def _sync(self):
+        if self._fh is not None and self._need_sync:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+        self._need_sync = False
+        self._last_sync = time.time()
+    def sync(self, force=False):
+        with self.lock:
+            if not force and time.time() - self._last_sync < self.sync_interval:
+                return
+            self._sync()
+    def checkpoint(self, seq):
+        """Mark every entry up to ``seq`` as stored and remove journal files
+        that are no longer needed
+        """
+        with self.lock:
+            seq = min(seq, self.seq)
+            if seq <= self.committed_seq:
+                return
+            self.write_checkpoint(seq)
+            self.committed_seq = seq
+            files = []
+            try:
+                for i, (start_seq, last_seq, fn) in enumerate(self._files):
+                    if last_seq > seq:
+                        files.append((start_seq, last_seq, fn))
+                        continue
+                    if self._fh is not None and start_seq == self._file_start:
+                        self.close_file()
+                    try:
+                        os.remove(fn)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            files.extend(self._files[i:])
+                            raise
+            finally:
+                self._files = files
+    def close(self):
+        with self.lock:
+            self.close_file()
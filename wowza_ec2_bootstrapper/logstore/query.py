@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+"""Streaming queries over stored access log records
+
+Records are read one at a time from the store and filtered as they are
+read, so memory use does not depend on the size of the store.
+
+Example::
+
+    python -m wowza_ec2_bootstrapper.logstore.query --storage segment \\
+        --start '2016-05-01 20:00' --end '2016-05-01 20:15' \\
+        --field x_app=live --field x_event=play --format tsv
+"""
+
+import sys
+import calendar
+import datetime
+import argparse
+import itertools
+
+import ujson as json
+
+from wowza_ec2_bootstrapper.logstore import BaseStore, record_to_dict
+
+FILTER_FIELDS = ['x_app', 'x_sname', 'c_ip', 'x_event']
+
+def parse_timestamp(value):
+    """Parse a timestamp given as seconds since the epoch or a UTC date string
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        try:
+            dt = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(dt.utctimetuple())
+    raise ValueError('Could not parse timestamp %r' % (value))
+
+def query(store=None, start=None, end=None, limit=None, offset=0, **filters):
+    """Generator of records from ``store`` matching the given filters
+
+    ``store`` may be a :class:`BaseStore` instance or ``None`` to build one
+    from the ``storage`` and ``filename`` keyword arguments.
+    """
+    store_kwargs = {}
+    for key in ['storage', 'filename']:
+        if key in filters:
+            store_kwargs[key] = filters.pop(key)
+    if store is None:
+        store = BaseStore.create(**store_kwargs)
+    start = parse_timestamp(start)
+    end = parse_timestamp(end)
+    records = store.search(start, end, **filters)
+    stop = None
+    if limit is not None:
+        stop = offset + limit
+    return itertools.islice(records, offset, stop)
+
+def write_jsonl(records, fh=None):
+    if fh is None:
+        fh = sys.stdout
+    count = 0
+    for record in records:
+        fh.write(json.dumps(record_to_dict(record)))
+        fh.write('\n')
+        count += 1
+    return count
+
+def format_tsv_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def write_tsv(records, fh=None, fields=None, header=True):
+    if fh is None:
+        fh = sys.stdout
+    count = 0
+    for record in records:
+        if fields is None:
+            fields = record._fields
+        if header:
+            fh.write('\t'.join(fields) + '\n')
+            header = False
+        values = [getattr(record, fname, None) for fname in fields]
+        values = [format_tsv_value(v) for v in values]
+        fh.write('\t'.join(values) + '\n')
+        count += 1
+    return count
+
+def build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--storage', default='tinydb')
+    p.add_argument('--filename')
+    p.add_argument('--start', help='Start time (epoch seconds or UTC "YYYY-mm-dd HH:MM:SS")')
+    p.add_argument('--end', help='End time (exclusive)')
+    for fname in FILTER_FIELDS:
+        p.add_argument('--%s' % (fname), action='append', dest=fname)
+    p.add_argument(
+        '--field', action='append', default=[], metavar='NAME=VALUE',
+        help='Filter on any other field (may be repeated)',
+    )
+    p.add_argument('--limit', type=int)
+    p.add_argument('--offset', type=int, default=0)
+    p.add_argument('--format', choices=['jsonl', 'tsv'], default='jsonl')
+    p.add_argument('--fields', help='Comma separated fields for tsv output')
+    return p
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    filters = {}
+    for fname in FILTER_FIELDS:
+        filters[fname] = getattr(args, fname)
+    for s in args.field:
+        fname, value = s.split('=', 1)
+        filters.setdefault(fname, [])
+        if filters[fname] is None:
+            filters[fname] = []
+        filters[fname].append(value)
+    records = query(
+        storage=args.storage, filename=args.filename,
+        start=args.start, end=args.end,
+        limit=args.limit, offset=args.offset,
+        **filters
+    )
+    if args.format == 'tsv':
+        fields = None
+        if args.fields:
+            fields = args.fields.split(',')
+        return write_tsv(records, fields=fields)
+    return write_jsonl(records)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import collections
+
+_record_classes = {}
+
+def get_record_class(field_names):
+    """Get the namedtuple class for the given field names
+
+    Classes are cached so every record parsed with the same layout shares a
+    single class (and a single copy of the field names).
+    """
+    field_names = tuple(field_names)
+    cls = _record_classes.get(field_names)
+    if cls is None:
+        cls = _record_classes[field_names] = collections.namedtuple(
+            'LogRecord', field_names,
+        )
+    return cls
+
+def record_to_dict(record):
+    return dict(zip(record._fields, record))
+
+def build_field_filters(filters):
+    """Normalize ``filters`` (field names mapped to a value or a list of
+    accepted values) to a list of ``(field_name, set_of_values)``
+    """
+    result = []
+    for fname, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = set(value)
+        else:
+            value = set([value])
+        result.append((fname, value))
+    return result
+
+def match_fields(record, field_filters):
+    for fname, value in field_filters:
+        if getattr(record, fname, None) not in value:
+            return False
+    return True
+
+class RecordParser(object):
+    """Parses raw tab-separated log lines into :func:`get_record_class`
+    tuples, inserting the receive time in the ``timestamp`` field
+
+    Lines with a different number of fields than the layout are padded or
+    truncated to fit and counted in :attr:`mismatched`.
+    """
+    def __init__(self, field_names):
+        self.field_names = tuple(field_names)
+        self.record_cls = get_record_class(self.field_names)
+        self.ts_index = self.field_names.index('timestamp')
+        self.num_fields = len(self.field_names)
+        self.mismatched = 0
+    def parse(self, line, ts):
+        values = line.rstrip('\n').split('\t')
+        values.insert(self.ts_index, ts)
+        n = self.num_fields
+        if len(values) != n:
+            self.mismatched += 1
+            values = (values + [None] * n)[:n]
+        return tuple.__new__(self.record_cls, values)
+    def parse_entries(self, entries):
+        parse = self.parse
+        return [parse(line, ts) for line, ts in entries]
+    def from_values(self, values):
+        return tuple.__new__(self.record_cls, values)
+    def from_dict(self, d):
+        return tuple.__new__(self.record_cls, [d.get(f) for f in self.field_names])
@@ -0,0 +1,343 @@
+#! /usr/bin/env python
+"""Bandwidth and viewer reports over stored access log records
+
+Records are read once into NumPy column arrays and every report is
+computed from those arrays with vectorized operations.
+
+Example::
+
+    python -m wowza_ec2_bootstrapper.logstore.report --storage segment \\
+        --start '2016-05-01' --end '2016-05-02' --format csv --output-dir ./report
+"""
+
+import os
+import csv
+import sys
+import datetime
+import argparse
+
+import numpy as np
+import ujson as json
+
+from wowza_ec2_bootstrapper.logstore import BaseStore
+from wowza_ec2_bootstrapper.logstore.query import parse_timestamp
+
+NUMERIC_FIELDS = ['sc_bytes', 'cs_bytes', 'x_duration']
+CATEGORY_FIELDS = ['x_app', 'x_sname', 'c_client_id', 'c_ip', 'x_event']
+MISSING = '-'
+DURATION_BINS = [0, 10, 30, 60, 300, 600, 1800, 3600, 7200, np.inf]
+
+def to_numeric(values, dtype):
+    """Convert a list of strings to an array, treating missing values as 0
+    """
+    arr = np.array([MISSING if v is None else v for v in values], dtype=np.unicode_)
+    arr[(arr == MISSING) | (arr == u'')] = u'0'
+    try:
+        return arr.astype(np.float64).astype(dtype)
+    except ValueError:
+        result = np.zeros(len(arr), dtype=dtype)
+        for i, v in enumerate(arr):
+            try:
+                result[i] = float(v)
+            except ValueError:
+                pass
+        return result
+
+class CategoryEncoder(object):
+    """Assigns integer codes to string values as they are seen
+    """
+    def __init__(self):
+        self.codes = {}
+    def encode(self, values):
+        codes = self.codes
+        setdefault = codes.setdefault
+        return np.array(
+            [setdefault(MISSING if v is None else v, len(codes)) for v in values],
+            dtype=np.int64,
+        )
+    def get_categories(self):
+        categories = np.empty(len(self.codes), dtype=object)
+        for value, code in self.codes.iteritems():
+            categories[code] = value
+        return categories
+
+def get_column(records, fname):
+    """Get the values of ``fname`` from a list of records
+    """
+    if not len(records):
+        return []
+    fields = records[0]._fields
+    if fname in fields and all(r._fields is fields for r in records):
+        i = fields.index(fname)
+        return [r[i] for r in records]
+    return [getattr(r, fname, None) for r in records]
+
+class ColumnSet(object):
+    """Columns loaded from a store
+
+    ``timestamp`` and the :data:`NUMERIC_FIELDS` are arrays of numbers.
+    Each of the :data:`CATEGORY_FIELDS` is an array of integer codes with
+    the matching values in :attr:`categories`.
+    """
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+        self._session_order = None
+    def __len__(self):
+        return len(self.columns['timestamp'])
+    def __getitem__(self, key):
+        return self.columns[key]
+    @classmethod
+    def from_records(cls, records, chunk_size=100000):
+        """Build from an iterable of records.  Values are collected in
+        chunks of ``chunk_size`` records and converted per chunk
+        """
+        numeric = {fname:[] for fname in ['timestamp'] + NUMERIC_FIELDS}
+        codes = {fname:[] for fname in CATEGORY_FIELDS}
+        encoders = {fname:CategoryEncoder() for fname in CATEGORY_FIELDS}
+        chunk = []
+        def add_chunk():
+            if not len(chunk):
+                return
+            numeric['timestamp'].append(
+                np.array(get_column(chunk, 'timestamp'), dtype=np.float64)
+            )
+            for fname in NUMERIC_FIELDS:
+                dtype = np.float64 if fname == 'x_duration' else np.int64
+                numeric[fname].append(to_numeric(get_column(chunk, fname), dtype))
+            for fname in CATEGORY_FIELDS:
+                codes[fname].append(encoders[fname].encode(get_column(chunk, fname)))
+            del chunk[:]
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                add_chunk()
+        add_chunk()
+        columns = {}
+        for fname, arrays in numeric.items() + codes.items():
+            if len(arrays):
+                columns[fname] = np.concatenate(arrays)
+            else:
+                columns[fname] = np.zeros(0, dtype=np.int64)
+        categories = {}
+        for fname, encoder in encoders.items():
+            categories[fname] = encoder.get_categories()
+        return cls(columns, categories)
+    @classmethod
+    def from_store(cls, store, start=None, end=None, **kwargs):
+        return cls.from_records(store.iter_records(start, end), **kwargs)
+    def get_category(self, fname, code):
+        return self.categories[fname][code]
+    def stream_keys(self):
+        """Get ``(codes, pairs)`` for each (app, stream) combination where
+        ``pairs`` is an array of ``[app_code, stream_code]`` rows
+        """
+        app = self['x_app']
+        stream = self['x_sname']
+        combined = app * (len(self.categories['x_sname']) or 1) + stream
+        uniq, codes = np.unique(combined, return_inverse=True)
+        n = len(self.categories['x_sname']) or 1
+        pairs = np.column_stack([uniq // n, uniq % n])
+        return codes, pairs
+    def session_order(self):
+        """Get ``(order, group_start)``: the index that sorts records by
+        session (client, app, stream) then time, and a boolean array marking
+        the first record of each session in that order
+        """
+        if self._session_order is not None:
+            return self._session_order
+        client = self['c_client_id']
+        order = np.lexsort((self['timestamp'], self['x_sname'], self['x_app'], client))
+        keys = np.column_stack([client, self['x_app'], self['x_sname']])[order]
+        group_start = np.ones(len(order), dtype=bool)
+        if len(order) > 1:
+            group_start[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+        self._session_order = order, group_start
+        return self._session_order
+    def byte_deltas(self, fname='sc_bytes'):
+        """Convert the cumulative per-session byte counts Wowza reports into
+        the bytes transferred since the session's previous record
+        """
+        values = self[fname]
+        if not len(values):
+            return np.zeros(0, dtype=np.int64)
+        order, group_start = self.session_order()
+        sorted_values = values[order]
+        deltas = np.empty_like(sorted_values)
+        deltas[0] = sorted_values[0]
+        deltas[1:] = sorted_values[1:] - sorted_values[:-1]
+        deltas[group_start] = sorted_values[group_start]
+        deltas[deltas < 0] = 0
+        result = np.empty_like(deltas)
+        result[order] = deltas
+        return result
+
+def per_minute(columns, interval=60):
+    """Bytes, bandwidth, events and unique client IPs per ``interval``
+    seconds
+    """
+    if not len(columns):
+        return []
+    minute = (columns['timestamp'] // interval).astype(np.int64)
+    first = minute.min()
+    idx = minute - first
+    n = idx.max() + 1
+    sc = np.bincount(idx, weights=columns.byte_deltas('sc_bytes'), minlength=n)
+    cs = np.bincount(idx, weights=columns.byte_deltas('cs_bytes'), minlength=n)
+    events = np.bincount(idx, minlength=n)
+    ip = columns['c_ip']
+    pairs = np.unique(idx * (len(columns.categories['c_ip']) or 1) + ip)
+    clients = np.bincount(pairs // (len(columns.categories['c_ip']) or 1), minlength=n)
+    rows = []
+    for i in np.flatnonzero(events):
+        ts = (first + i) * interval
+        rows.append({
+            'timestamp':int(ts),
+            'time':datetime.datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'),
+            'sc_bytes':int(sc[i]),
+            'cs_bytes':int(cs[i]),
+            'bandwidth_bps':float(sc[i]) * 8 / interval,
+            'events':int(events[i]),
+            'unique_clients':int(clients[i]),
+        })
+    return rows
+
+def top_streams(columns, n=10):
+    """The ``n`` (app, stream) pairs with the most bytes sent
+    """
+    if not len(columns):
+        return []
+    keys, pairs = columns.stream_keys()
+    nkeys = len(pairs)
+    sc = np.bincount(keys, weights=columns.byte_deltas('sc_bytes'), minlength=nkeys)
+    events = np.bincount(keys, minlength=nkeys)
+    client = columns['c_client_id']
+    nclients = len(columns.categories['c_client_id']) or 1
+    sessions = np.bincount(np.unique(keys * nclients + client) // nclients, minlength=nkeys)
+    rows = []
+    for i in np.argsort(-sc, kind='mergesort')[:n]:
+        rows.append({
+            'x_app':columns.get_category('x_app', pairs[i][0]),
+            'x_sname':columns.get_category('x_sname', pairs[i][1]),
+            'sc_bytes':int(sc[i]),
+            'sessions':int(sessions[i]),
+            'events':int(events[i]),
+        })
+    return rows
+
+def session_durations(columns, bins=DURATION_BINS):
+    """Histogram of session durations (the largest ``x_duration`` of each
+    client/app/stream session)
+    """
+    if not len(columns):
+        return []
+    order, group_start = columns.session_order()
+    durations = columns['x_duration'][order]
+    starts = np.flatnonzero(group_start)
+    longest = np.maximum.reduceat(durations, starts)
+    counts, edges = np.histogram(longest, bins=bins)
+    rows = []
+    for i, count in enumerate(counts):
+        rows.append({
+            'min_duration':float(edges[i]),
+            'max_duration':float(edges[i + 1]) if np.isfinite(edges[i + 1]) else None,
+            'sessions':int(count),
+        })
+    return rows
+
+def unique_clients(columns):
+    result = {}
+    for fname in ['c_ip', 'c_client_id']:
+        categories = columns.categories[fname]
+        codes = np.unique(columns[fname])
+        codes = codes[categories[codes] != MISSING] if len(codes) else codes
+        result[fname] = int(len(codes))
+    return result
+
+def build_report(columns, top=10, interval=60):
+    return {
+        'records':len(columns),
+        'per_minute':per_minute(columns, interval),
+        'top_streams':top_streams(columns, top),
+        'session_durations':session_durations(columns),
+        'unique_clients':unique_clients(columns),
+    }
+
+REPORT_COLUMNS = {
+    'per_minute':[
+        'time', 'timestamp', 'sc_bytes', 'cs_bytes', 'bandwidth_bps',
+        'events', 'unique_clients',
+    ],
+    'top_streams':['x_app', 'x_sname', 'sc_bytes', 'sessions', 'events'],
+    'session_durations':['min_duration', 'max_duration', 'sessions'],
+    'summary':['records', 'unique_c_ip', 'unique_c_client_id'],
+}
+
+def get_table(report, name):
+    """Rows of the ``name`` table.  The ``summary`` table holds the single
+    values of the report (``records`` and ``unique_clients``)
+    """
+    if name == 'summary':
+        row = {'records':report['records']}
+        for fname, count in report['unique_clients'].items():
+            row['unique_%s' % (fname)] = count
+        return [row]
+    return report[name]
+
+def encode_row(row):
+    d = {}
+    for key, value in row.items():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        d[key] = value
+    return d
+
+def write_csv(report, dirname):
+    """Write each table of ``report`` to ``<dirname>/<name>.csv``
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    filenames = []
+    for name, fields in sorted(REPORT_COLUMNS.items()):
+        fn = os.path.join(dirname, '%s.csv' % (name))
+        with open(fn, 'wb') as f:
+            w = csv.DictWriter(f, fields)
+            w.writeheader()
+            for row in get_table(report, name):
+                w.writerow(encode_row(row))
+        filenames.append(fn)
+    return filenames
+
+def write_json(report, fh=None):
+    if fh is None:
+        fh = sys.stdout
+    fh.write(json.dumps(report))
+    fh.write('\n')
+
+def build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--storage', default='tinydb')
+    p.add_argument('--filename')
+    p.add_argument('--start', help='Start time (epoch seconds or UTC "YYYY-mm-dd HH:MM:SS")')
+    p.add_argument('--end', help='End time (exclusive)')
+    p.add_argument('--top', type=int, default=10, help='Number of streams to list')
+    p.add_argument('--interval', type=int, default=60, help='Seconds per bandwidth row')
+    p.add_argument('--format', choices=['json', 'csv'], default='json')
+    p.add_argument('--output-dir', dest='output_dir', default='.',
+                   help='Directory for csv output')
+    return p
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    store = BaseStore.create(storage=args.storage, filename=args.filename)
+    columns = ColumnSet.from_store(
+        store, parse_timestamp(args.start), parse_timestamp(args.end),
+    )
+    report = build_report(columns, top=args.top, interval=args.interval)
+    if args.format == 'csv':
+        return write_csv(report, args.output_dir)
+    write_json(report)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import threading
+import traceback
+
+from wowza_ec2_bootstrapper.udp_stats import parse_int, SESSION_END_EVENTS
+from wowza_ec2_bootstrapper.logstore import BaseStore, get_record_class
+
+AGGREGATE_FIELDS = (
+    'timestamp', 'x_app', 'x_sname',
+    'sc_bytes', 'cs_bytes', 'sessions', 'events', 'connects', 'disconnects',
+)
+
+class Aggregator(object):
+    """Sums records into per ``interval`` second counters for each app and
+    stream
+
+    Byte counts are derived from the cumulative ``sc_bytes``/``cs_bytes``
+    values of each ``c_client_id`` (as in :class:`udp_stats.StreamStats`)
+    and ``sessions`` is the number of distinct clients seen in the interval.
+    The last values of each session are kept in :attr:`clients` (see
+    :meth:`get_clients`) so they can carry over to the next run.
+    """
+    def __init__(self, interval=60, clients=None):
+        self.interval = interval
+        self.record_cls = get_record_class(AGGREGATE_FIELDS)
+        self.buckets = {}
+        self.clients = {}
+        if clients is not None:
+            for client_id, app, stream, sc_bytes, cs_bytes, ts in clients:
+                self.clients[(client_id, app, stream)] = (sc_bytes, cs_bytes, ts)
+    def add_records(self, records):
+        interval = self.interval
+        buckets = self.buckets
+        clients = self.clients
+        for r in records:
+            ts = r.timestamp // interval * interval
+            app = getattr(r, 'x_app', None)
+            stream = getattr(r, 'x_sname', None)
+            key = (ts, app, stream)
+            c = buckets.get(key)
+            if c is None:
+                # sc_bytes, cs_bytes, client ids, events, connects, disconnects
+                c = buckets[key] = [0, 0, set(), 0, 0, 0]
+            event = getattr(r, 'x_event', None)
+            c[3] += 1
+            if event == 'connect':
+                c[4] += 1
+            elif event == 'disconnect':
+                c[5] += 1
+            client_id = getattr(r, 'c_client_id', None)
+            if client_id is None or client_id == '-':
+                continue
+            c[2].add(client_id)
+            sc_bytes = parse_int(getattr(r, 'sc_bytes', None))
+            cs_bytes = parse_int(getattr(r, 'cs_bytes', None))
+            session_key = (client_id, app, stream)
+            last_sc, last_cs, last_ts = clients.get(session_key, (0, 0, None))
+            c[0] += max(sc_bytes - last_sc, 0)
+            c[1] += max(cs_bytes - last_cs, 0)
+            if event in SESSION_END_EVENTS:
+                clients.pop(session_key, None)
+            else:
+                clients[session_key] = (sc_bytes, cs_bytes, r.timestamp)
+    def pop_records(self):
+        """Get the aggregate records computed so far (ordered by timestamp)
+        and reset the counters.  Session byte offsets are kept
+        """
+        new = tuple.__new__
+        result = []
+        for (ts, app, stream), c in sorted(self.buckets.items()):
+            result.append(new(self.record_cls, [
+                ts, app, stream, c[0], c[1], len(c[2]), c[3], c[4], c[5],
+            ]))
+        self.buckets = {}
+        return result
+    def get_clients(self, expire_before=None):
+        """Get the session byte offsets as a list of
+        ``[client_id, app, stream, sc_bytes, cs_bytes, timestamp]``, first
+        forgetting sessions not seen since ``expire_before``
+        """
+        if expire_before is not None:
+            for key, value in self.clients.items():
+                if value[2] < expire_before:
+                    del self.clients[key]
+        return [list(key) + list(value) for key, value in self.clients.iteritems()]
+
+class RetentionPolicy(object):
+    """Keeps raw records in ``store`` for ``raw_days`` days
+
+    Older records are compacted into :data:`AGGREGATE_FIELDS` records per
+    ``aggregate_interval`` seconds, written to a second store of the same
+    type (``rollup_filename``, by default the store's filename with
+    ``.rollup`` appended) and then deleted.  Aggregates older than
+    ``aggregate_days`` are deleted as well (kept forever if ``None``).
+
+    The cutoff is aligned by :meth:`BaseStore.get_retention_cutoff` so that
+    every record compacted is also deleted.  Progress is saved to
+    ``state_filename`` after every ``chunk_interval`` seconds of records
+    compacted so an interrupted run does not aggregate the same records
+    twice.  The state also holds the byte offsets of open sessions so the
+    next run only counts new bytes (sessions with no records for
+    ``session_timeout`` seconds are forgotten).  Records arriving for a
+    partition while it is being compacted may be deleted with it, so
+    ``raw_days`` should be well beyond how late records can arrive.
+    """
+    def __init__(self, store, **kwargs):
+        self.store = store
+        self.raw_days = float(kwargs.get('raw_days', 7))
+        aggregate_days = kwargs.get('aggregate_days')
+        if aggregate_days is not None:
+            aggregate_days = float(aggregate_days)
+        self.aggregate_days = aggregate_days
+        self.aggregate_interval = int(kwargs.get('aggregate_interval', 60))
+        self.chunk_interval = int(kwargs.get('chunk_interval', 3600))
+        self.session_timeout = float(kwargs.get('session_timeout', 86400))
+        rollup_filename = kwargs.get('rollup_filename')
+        if rollup_filename is None:
+            rollup_filename = '.'.join([store.filename, 'rollup'])
+        state_filename = kwargs.get('state_filename')
+        if state_filename is None:
+            state_filename = '.'.join([store.filename, 'retention'])
+        self.state_filename = os.path.expanduser(state_filename)
+        self.rollup = BaseStore.create(
+            storage=store.store_name,
+            filename=rollup_filename,
+            field_names=AGGREGATE_FIELDS,
+        )
+    def read_state(self):
+        if not os.path.exists(self.state_filename):
+            return {}
+        with open(self.state_filename, 'rb') as f:
+            return json.loads(f.read())
+    def write_state(self, state):
+        tmp_fn = '.'.join([self.state_filename, 'tmp'])
+        with open(tmp_fn, 'wb') as f:
+            f.write(json.dumps(state))
+        os.rename(tmp_fn, self.state_filename)
+    def get_cutoff(self, now=None):
+        if now is None:
+            now = time.time()
+        cutoff = now - self.raw_days * 86400
+        interval = self.aggregate_interval
+        cutoff = int(cutoff // interval * interval)
+        return self.store.get_retention_cutoff(cutoff)
+    def run(self, now=None):
+        """Compact and delete expired records.  Returns the number of raw
+        records compacted
+        """
+        if now is None:
+            now = time.time()
+        cutoff = self.get_cutoff(now)
+        store = self.store
+        if store.concurrent_reads:
+            count = self.compact(cutoff)
+        else:
+            with store.lock:
+                count = self.compact(cutoff)
+        store.remove_before(cutoff)
+        if self.aggregate_days is not None:
+            self.rollup.remove_before(now - self.aggregate_days * 86400)
+        return count
+    def compact(self, cutoff):
+        """Aggregate all raw records before ``cutoff``.  Records before the
+        point reached by a previous (possibly interrupted) run have already
+        been aggregated, so they are deleted (as far as the store's
+        partitions allow) and skipped
+        """
+        state = self.read_state()
+        compacted_until = state.get('compacted_until')
+        if compacted_until is not None:
+            self.store.remove_before(compacted_until)
+        chunk = self.chunk_interval
+        aggregator = Aggregator(self.aggregate_interval, state.get('clients'))
+        chunk_end = None
+        count = 0
+        for record in self.store.iter_records(compacted_until, cutoff):
+            if chunk_end is None:
+                chunk_end = (record.timestamp // chunk + 1) * chunk
+            elif record.timestamp >= chunk_end:
+                self.write_aggregates(aggregator, state, chunk_end)
+                chunk_end = (record.timestamp // chunk + 1) * chunk
+            aggregator.add_records([record])
+            count += 1
+        self.write_aggregates(aggregator, state, cutoff)
+        return count
+    def write_aggregates(self, aggregator, state, compacted_until):
+        records = aggregator.pop_records()
+        if len(records):
+            self.rollup.write_entries(records)
+            self.rollup.close()
+        state['compacted_until'] = compacted_until
+        state['clients'] = aggregator.get_clients(compacted_until - self.session_timeout)
+        self.write_state(state)
+
+class RetentionTask(threading.Thread):
+    """Runs :meth:`RetentionPolicy.run` every ``interval`` seconds
+    """
+    def __init__(self, policy, interval=3600.):
+        super(RetentionTask, self).__init__()
+        self.daemon = True
+        self.policy = policy
+        self.interval = interval
+        self.last_run = None
+        self.compacted = 0
+        self.errors = 0
+        self._stop_event = threading.Event()
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.compacted += self.policy.run()
+                self.last_run = time.time()
+            except Exception:
+                self.errors += 1
+                print('retention error\n%s' % (traceback.format_exc()))
+            self._stop_event.wait(self.interval)
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
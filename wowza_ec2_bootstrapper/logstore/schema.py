@@ -0,0 +1,61 @@
+import os
+import threading
+
+import ujson as json
+
+class SchemaRegistry(object):
+    """Numbered record layouts stored alongside a log store
+
+    Every distinct tuple of field names written to a store is given the next
+    version number the first time it is seen.  Stores record the version
+    with the data they write so records can later be read with the layout
+    they were written in, even after the Wowza log layout has changed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.fields = {}
+        self.read()
+    def read(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            data = json.loads(f.read())
+        for d in data['versions']:
+            fields = tuple(d['fields'])
+            self.versions[fields] = d['version']
+            self.fields[d['version']] = fields
+    def write(self):
+        data = {'versions':[]}
+        for version, fields in sorted(self.fields.items()):
+            data['versions'].append({'version':version, 'fields':list(fields)})
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_fn = '.'.join([self.filename, 'tmp'])
+        with open(tmp_fn, 'wb') as f:
+            f.write(json.dumps(data))
+        os.rename(tmp_fn, self.filename)
+    @property
+    def latest(self):
+        if not len(self.fields):
+            return None
+        return max(self.fields.keys())
+    def get_version(self, fields):
+        """Get the version number for ``fields``, registering it if needed
+        """
+        fields = tuple(fields)
+        version = self.versions.get(fields)
+        if version is not None:
+            return version
+        with self.lock:
+            version = self.versions.get(fields)
+            if version is None:
+                version = (self.latest or 0) + 1
+                self.versions[fields] = version
+                self.fields[version] = fields
+                self.write()
+        return version
+    def get_fields(self, version):
+        return self.fields.get(version)
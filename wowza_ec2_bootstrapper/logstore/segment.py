@@ -0,0 +1,601 @@
+import os
+import time
+import gzip
+import mmap
+import zlib
+import shutil
+import datetime
+import calendar
+import itertools
+
+import ujson as json
+
+from wowza_ec2_bootstrapper.logstore import (
+    BaseStore, get_record_class, build_field_filters, match_fields,
+)
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Fields with few distinct values that are dictionary encoded by default
+DEFAULT_DICT_FIELDS = [
+    'date', 'tz', 'x_event', 'x_category', 'x_severity', 'x_status', 'x_ctx',
+    'x_vhost', 'x_app', 'x_appinst', 's_ip', 's_port', 's_uri', 'c_proto',
+    'c_referrer', 'c_user_agent', 'x_sname', 'x_sname_query', 'x_file_name',
+    'x_file_ext', 'x_suri', 'x_suri_stem', 'x_suri_query', 'cs_uri_stem',
+    'cs_uri_query',
+]
+
+def gzip_member(data, level=6):
+    c = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return c.compress(data) + c.flush()
+
+class SegmentWriter(object):
+    """An open segment file along with the index data for what has been
+    written to it
+
+    Records are grouped into blocks of roughly ``block_size`` bytes.  The
+    index holds the byte offset, record count and min/max timestamp of each
+    block so readers can seek directly to the blocks covering a time range.
+    """
+    def __init__(self, filename, fields, block_size, schema=None):
+        self.filename = filename
+        self.fields = fields
+        self.schema = schema
+        self.block_size = block_size
+        self.start_time = time.time()
+        self.count = 0
+        self.min_ts = None
+        self.max_ts = None
+        self.blocks = []
+        self._block_bytes = 0
+        self.fh = open(filename, 'ab')
+        self.bytes = 0
+        self.write_header()
+    def get_header(self):
+        header = {'fields':list(self.fields)}
+        if self.schema is not None:
+            header['schema'] = self.schema
+        return header
+    def write_header(self):
+        header = json.dumps(self.get_header()) + '\n'
+        self.fh.write(header)
+        self.bytes += len(header)
+    def write(self, records):
+        data = ''.join([json.dumps(r) + '\n' for r in records])
+        timestamps = [r.timestamp for r in records]
+        min_ts = min(timestamps)
+        max_ts = max(timestamps)
+        if not len(self.blocks) or self._block_bytes >= self.block_size:
+            self.blocks.append([self.bytes, min_ts, max_ts, 0])
+            self._block_bytes = 0
+        block = self.blocks[-1]
+        block[1] = min(block[1], min_ts)
+        block[2] = max(block[2], max_ts)
+        block[3] += len(records)
+        self.fh.write(data)
+        self.bytes += len(data)
+        self._block_bytes += len(data)
+        self.count += len(records)
+        if self.min_ts is None or min_ts < self.min_ts:
+            self.min_ts = min_ts
+        if self.max_ts is None or max_ts > self.max_ts:
+            self.max_ts = max_ts
+    def flush(self, fsync=False):
+        self.fh.flush()
+        if fsync:
+            os.fsync(self.fh.fileno())
+    def close(self, fsync=False):
+        self.flush(fsync)
+        self.fh.close()
+    def get_index(self):
+        return dict(
+            count=self.count,
+            min_ts=self.min_ts,
+            max_ts=self.max_ts,
+            end_offset=self.bytes,
+            blocks=self.blocks,
+            schema=self.schema,
+        )
+
+class CompressedSegmentWriter(SegmentWriter):
+    """Segment writer producing gzip compressed segments
+
+    Records are buffered until a block of ``block_size`` (uncompressed)
+    bytes is ready or the writer is flushed, then written as a single gzip
+    member.  The file is a valid multi-member gzip file and each indexed
+    block can be decompressed on its own.
+
+    Columns listed in ``dict_fields`` are dictionary encoded per block: the
+    block starts with a ``{"dict": {column: [values]}}`` line and records
+    store the position of their value in that list.
+    """
+    def __init__(self, filename, fields, block_size, level=6, dict_fields=None, schema=None):
+        self.level = level
+        if not dict_fields:
+            dict_fields = []
+        self.dict_columns = [i for i, f in enumerate(fields) if f in dict_fields]
+        self._reset_block()
+        super(CompressedSegmentWriter, self).__init__(
+            filename, fields, block_size, schema=schema,
+        )
+    def _reset_block(self):
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_count = 0
+        self._pending_min = None
+        self._pending_max = None
+        self._dicts = {col:{} for col in self.dict_columns}
+        self._dict_values = {col:[] for col in self.dict_columns}
+    def write_header(self):
+        header = json.dumps(self.get_header()) + '\n'
+        member = gzip_member(header, self.level)
+        self.fh.write(member)
+        self.bytes += len(member)
+    def encode_record(self, record):
+        if not self.dict_columns:
+            return json.dumps(record) + '\n'
+        values = list(record)
+        for col in self.dict_columns:
+            v = values[col]
+            d = self._dicts[col]
+            code = d.get(v)
+            if code is None:
+                code = d[v] = len(d)
+                self._dict_values[col].append(v)
+            values[col] = code
+        return json.dumps(values) + '\n'
+    def write(self, records):
+        lines = [self.encode_record(r) for r in records]
+        timestamps = [r.timestamp for r in records]
+        min_ts = min(timestamps)
+        max_ts = max(timestamps)
+        if self._pending_min is None or min_ts < self._pending_min:
+            self._pending_min = min_ts
+        if self._pending_max is None or max_ts > self._pending_max:
+            self._pending_max = max_ts
+        self._pending.extend(lines)
+        self._pending_bytes += sum(len(line) for line in lines)
+        self._pending_count += len(records)
+        if self._pending_bytes >= self.block_size:
+            self.finish_block()
+    def finish_block(self):
+        if not self._pending_count:
+            return
+        data = ''.join(self._pending)
+        if self.dict_columns:
+            d = {str(col):self._dict_values[col] for col in self.dict_columns}
+            data = json.dumps({'dict':d}) + '\n' + data
+        member = gzip_member(data, self.level)
+        self.blocks.append([
+            self.bytes, self._pending_min, self._pending_max, self._pending_count,
+        ])
+        self.fh.write(member)
+        self.bytes += len(member)
+        self.count += self._pending_count
+        if self.min_ts is None or self._pending_min < self.min_ts:
+            self.min_ts = self._pending_min
+        if self.max_ts is None or self._pending_max > self.max_ts:
+            self.max_ts = self._pending_max
+        self._reset_block()
+    def flush(self, fsync=False):
+        self.finish_block()
+        super(CompressedSegmentWriter, self).flush(fsync)
+
+class MappedSegmentReader(object):
+    """Reads records from an uncompressed segment through a memory map
+
+    Only the byte ranges of index blocks that overlap the requested time
+    range are touched, and they are copied out of the map ``chunk_size``
+    bytes at a time (split on record boundaries), so memory use does not
+    depend on the size of the segment.  When ``timestamp`` is the first
+    field it is parsed from the start of each line without decoding the
+    rest, and field filters are checked by searching the line for each
+    accepted value (as written by the segment writer) before the record is
+    decoded.
+    """
+    def __init__(self, filename, chunk_size=1048576):
+        self.filename = filename
+        self.chunk_size = chunk_size
+    def get_ranges(self, header_end, size, index=None, start=None, end=None):
+        """Byte ranges of the file holding records that may be in range
+        """
+        if index is None or (start is None and end is None):
+            return [(header_end, size)]
+        blocks = index['blocks']
+        end_offset = index['end_offset']
+        ranges = []
+        for i, (offset, min_ts, max_ts, count) in enumerate(blocks):
+            if start is not None and max_ts < start:
+                continue
+            if end is not None and min_ts >= end:
+                continue
+            if i + 1 < len(blocks):
+                block_end = blocks[i + 1][0]
+            else:
+                block_end = end_offset
+            if len(ranges) and ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], block_end)
+            else:
+                ranges.append((offset, block_end))
+        if size > end_offset:
+            ranges.append((end_offset, size))
+        return ranges
+    def iter_chunks(self, mm, pos, range_end):
+        """Yield lists of complete lines between ``pos`` and ``range_end``
+        """
+        chunk_size = self.chunk_size
+        while pos < range_end:
+            chunk_end = min(pos + chunk_size, range_end)
+            eol = mm.rfind('\n', pos, chunk_end)
+            if eol == -1:
+                # a single line longer than chunk_size (or a partial line)
+                eol = mm.find('\n', chunk_end, range_end)
+                if eol == -1:
+                    # partially written record at the end of a segment
+                    return
+            lines = mm[pos:eol].split('\n')
+            pos = eol + 1
+            yield lines
+    def iter_records(self, index=None, start=None, end=None, field_filters=None):
+        with open(self.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for record in self._iter_records(mm, size, index, start, end, field_filters):
+                    yield record
+            finally:
+                mm.close()
+    def _iter_records(self, mm, size, index, start, end, field_filters):
+        header_end = mm.find('\n')
+        if header_end == -1:
+            return
+        fields = json.loads(mm[:header_end])['fields']
+        record_cls = get_record_class(fields)
+        new = tuple.__new__
+        loads = json.loads
+        ts_first = fields[0] == 'timestamp'
+        check_ts = start is not None or end is not None
+        needles = []
+        for fname, values in field_filters or []:
+            needles.append([json.dumps(v) for v in values])
+        def in_range(ts):
+            if start is not None and ts < start:
+                return False
+            if end is not None and ts >= end:
+                return False
+            return True
+        def has_needles(line):
+            for values in needles:
+                for needle in values:
+                    if needle in line:
+                        break
+                else:
+                    return False
+            return True
+        ranges = self.get_ranges(header_end + 1, size, index, start, end)
+        for pos, range_end in ranges:
+            for lines in self.iter_chunks(mm, pos, range_end):
+                if not check_ts and not needles:
+                    for line in lines:
+                        yield new(record_cls, loads(line))
+                    continue
+                for line in lines:
+                    if check_ts and ts_first:
+                        if not in_range(loads(line[1:line.find(',')])):
+                            continue
+                    if needles and not has_needles(line):
+                        continue
+                    record = new(record_cls, loads(line))
+                    if check_ts and not ts_first and not in_range(record.timestamp):
+                        continue
+                    if field_filters and not match_fields(record, field_filters):
+                        continue
+                    yield record
+
+class SegmentStore(BaseStore):
+    """Append-only storage using line-delimited JSON segment files
+
+    Records are partitioned by their ``timestamp`` into windows of
+    ``partition_interval`` seconds, each stored in its own sub-directory of
+    ``filename``.  Each batch is appended to the current segment of its
+    partition so the cost of a write depends only on the batch size.  The
+    first line of a segment is a header holding the field names and every
+    following line is a JSON array of values in that order.  A new
+    segment is started when the current one reaches ``segment_size`` bytes
+    or is older than ``segment_interval`` seconds.  If ``fsync`` is set, the
+    segment is synced to disk on every flush.
+
+    Every partition has an ``index.json`` with the timestamp range and block
+    offsets of its segments (updated on flush), which lets
+    :meth:`iter_records` skip partitions and blocks outside a time range.
+
+    With ``compress`` set, new segments are written by
+    :class:`CompressedSegmentWriter` (``compress_level`` and ``dict_fields``
+    are passed to it; ``dict_fields=True`` uses :data:`DEFAULT_DICT_FIELDS`).
+    Compressed and plain segments can be mixed in the same store and are
+    both read by :meth:`iter_records`.
+
+    The header of each segment (and its index entry) also holds the
+    :class:`SchemaRegistry` version of its layout, and records are always
+    read with the layout of the segment they are in, so segments written
+    before and after a change to the log fields can be mixed.
+
+    Uncompressed segments are read with :class:`MappedSegmentReader` unless
+    ``mmap`` is ``False``.  :meth:`search` uses it to skip decoding records
+    that do not match.
+    """
+    store_name = 'segment'
+    default_filename = '~/wowzalog.segments'
+    partition_prefix = 'partition-'
+    segment_prefix = 'segment-'
+    segment_ext = '.jsonl'
+    compressed_ext = '.jsonl.gz'
+    index_filename = 'index.json'
+    concurrent_reads = True
+    @property
+    def schema_filename(self):
+        return os.path.join(self.filename, 'schemas.json')
+    def __init__(self, **kwargs):
+        super(SegmentStore, self).__init__(**kwargs)
+        self.segment_size = int(kwargs.get('segment_size', 64 * 1024 * 1024))
+        self.segment_interval = float(kwargs.get('segment_interval', 3600.))
+        self.partition_interval = int(kwargs.get('partition_interval', 3600))
+        self.index_block_size = int(kwargs.get('index_block_size', 64 * 1024))
+        self.fsync = kwargs.get('fsync', False)
+        self.compress = kwargs.get('compress', False)
+        self.compress_level = int(kwargs.get('compress_level', 6))
+        dict_fields = kwargs.get('dict_fields')
+        if dict_fields is True:
+            dict_fields = DEFAULT_DICT_FIELDS
+        elif isinstance(dict_fields, basestring):
+            dict_fields = dict_fields.split(',')
+        self.dict_fields = dict_fields
+        self.mmap = kwargs.get('mmap', True)
+        self._writers = {}
+        self._indexes = {}
+    def open(self):
+        if not os.path.exists(self.filename):
+            os.makedirs(self.filename)
+    def close(self):
+        with self.lock:
+            if not len(self._writers):
+                return
+            super(SegmentStore, self).close()
+            for key in self._writers.keys():
+                self.close_segment(key)
+    def get_partition_key(self, ts):
+        interval = self.partition_interval
+        return int(ts // interval * interval)
+    def get_partition_dirname(self, key):
+        dt = datetime.datetime.utcfromtimestamp(key)
+        dt_str = dt.strftime('%Y%m%d_%H%M%S')
+        return os.path.join(self.filename, ''.join([self.partition_prefix, dt_str]))
+    def parse_partition_dirname(self, dirname):
+        dt_str = os.path.basename(dirname)[len(self.partition_prefix):]
+        dt = datetime.datetime.strptime(dt_str, '%Y%m%d_%H%M%S')
+        return calendar.timegm(dt.utctimetuple())
+    def open_segment(self, key, fields):
+        dirname = self.get_partition_dirname(key)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        dt_str = datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        if self.compress:
+            ext = self.compressed_ext
+        else:
+            ext = self.segment_ext
+        i = 0
+        while True:
+            fn = '%s%s-%04d%s' % (self.segment_prefix, dt_str, i, ext)
+            fn = os.path.join(dirname, fn)
+            if not os.path.exists(fn):
+                break
+            i += 1
+        schema = self.get_schema_version(fields)
+        if self.compress:
+            writer = CompressedSegmentWriter(
+                fn, fields, self.index_block_size,
+                level=self.compress_level, dict_fields=self.dict_fields,
+                schema=schema,
+            )
+        else:
+            writer = SegmentWriter(fn, fields, self.index_block_size, schema=schema)
+        self._writers[key] = writer
+        return writer
+    def close_segment(self, key):
+        writer = self._writers.pop(key, None)
+        if writer is None:
+            return
+        writer.close(self.fsync)
+        self.update_index(key, writer)
+    def rotate(self, key, fields=None):
+        writer = self._writers[key]
+        if fields is None:
+            fields = writer.fields
+        self.close_segment(key)
+        return self.open_segment(key, fields)
+    def check_rotate(self, key, now=None):
+        writer = self._writers[key]
+        if writer.bytes >= self.segment_size:
+            self.rotate(key)
+            return True
+        if now is None:
+            now = time.time()
+        if now - writer.start_time >= self.segment_interval:
+            self.rotate(key)
+            return True
+        return False
+    def close_idle_partitions(self):
+        """Close segments for partitions older than the previous window.
+        Late records for those partitions will start a new segment
+        """
+        if len(self._writers) < 3:
+            return
+        newest = max(self._writers.keys())
+        for key in self._writers.keys():
+            if key < newest - self.partition_interval:
+                self.close_segment(key)
+    def _write_entries(self, records):
+        def group_key(r):
+            return self.get_partition_key(r.timestamp), r._fields
+        for (key, fields), group in itertools.groupby(records, group_key):
+            writer = self._writers.get(key)
+            if writer is None:
+                writer = self.open_segment(key, fields)
+            elif fields != writer.fields:
+                writer = self.rotate(key, fields)
+            elif self.check_rotate(key):
+                writer = self._writers[key]
+            writer.write(list(group))
+        self.close_idle_partitions()
+    def _flush(self):
+        for key, writer in self._writers.items():
+            writer.flush(self.fsync)
+            self.update_index(key, writer)
+    def read_index(self, dirname):
+        fn = os.path.join(dirname, self.index_filename)
+        if not os.path.exists(fn):
+            return {'segments':{}}
+        with open(fn, 'rb') as f:
+            return json.loads(f.read())
+    def update_index(self, key, writer):
+        index = self._indexes.get(key)
+        dirname = self.get_partition_dirname(key)
+        if index is None:
+            index = self._indexes[key] = self.read_index(dirname)
+        index['segments'][os.path.basename(writer.filename)] = writer.get_index()
+        fn = os.path.join(dirname, self.index_filename)
+        tmp_fn = '.'.join([fn, 'tmp'])
+        with open(tmp_fn, 'wb') as f:
+            f.write(json.dumps(index))
+        os.rename(tmp_fn, fn)
+        if key not in self._writers:
+            # partition has no open segments, no need to keep its index cached
+            del self._indexes[key]
+    def iter_partitions(self):
+        if not os.path.exists(self.filename):
+            return
+        for fn in sorted(os.listdir(self.filename)):
+            if not fn.startswith(self.partition_prefix):
+                continue
+            dirname = os.path.join(self.filename, fn)
+            yield self.parse_partition_dirname(dirname), dirname
+    def iter_partition_segments(self, dirname):
+        for fn in sorted(os.listdir(dirname)):
+            if not fn.startswith(self.segment_prefix):
+                continue
+            if not fn.endswith(self.segment_ext) and not fn.endswith(self.compressed_ext):
+                continue
+            yield os.path.join(dirname, fn)
+    def iter_segment_filenames(self):
+        for key, dirname in self.iter_partitions():
+            for fn in self.iter_partition_segments(dirname):
+                yield fn
+    def iter_segment_records(self, filename, index=None, start=None, end=None):
+        """Yield records from a single segment file
+
+        If ``index`` (the segment's entry in the partition index) is given,
+        only the blocks overlapping ``start``/``end`` are read along with
+        anything written after the index was last updated.
+        """
+        def in_range(ts):
+            if start is not None and ts < start:
+                return False
+            if end is not None and ts >= end:
+                return False
+            return True
+        compressed = filename.endswith(self.compressed_ext)
+        with open(filename, 'rb') as raw:
+            def open_at(offset=None):
+                if offset is not None:
+                    raw.seek(offset)
+                if compressed:
+                    return gzip.GzipFile(fileobj=raw, mode='rb')
+                return raw
+            f = open_at()
+            header = f.readline()
+            if not header.endswith('\n'):
+                return
+            record_cls = get_record_class(json.loads(header)['fields'])
+            new = tuple.__new__
+            def read_lines(f, count=None):
+                decoders = None
+                i = 0
+                while count is None or i < count:
+                    try:
+                        line = f.readline()
+                    except (IOError, EOFError):
+                        # truncated gzip member at the end of a segment
+                        break
+                    if not line.endswith('\n'):
+                        # partially written record at the end of a segment
+                        break
+                    values = json.loads(line)
+                    if isinstance(values, dict):
+                        decoders = [(int(col), v) for col, v in values['dict'].items()]
+                        continue
+                    i += 1
+                    if decoders is not None:
+                        for col, v in decoders:
+                            values[col] = v[values[col]]
+                    record = new(record_cls, values)
+                    if in_range(record.timestamp):
+                        yield record
+            if index is None or (start is None and end is None):
+                for record in read_lines(f):
+                    yield record
+                return
+            for offset, min_ts, max_ts, count in index['blocks']:
+                if start is not None and max_ts < start:
+                    continue
+                if end is not None and min_ts >= end:
+                    continue
+                for record in read_lines(open_at(offset), count):
+                    yield record
+            for record in read_lines(open_at(index['end_offset'])):
+                yield record
+    def iter_records(self, start=None, end=None):
+        return self.search(start, end)
+    def search(self, start=None, end=None, **filters):
+        field_filters = build_field_filters(filters)
+        for key, dirname in self.iter_partitions():
+            if end is not None and key >= end:
+                break
+            if start is not None and key + self.partition_interval <= start:
+                continue
+            index = self.read_index(dirname)['segments']
+            for fn in self.iter_partition_segments(dirname):
+                seg_index = index.get(os.path.basename(fn))
+                if seg_index is not None and seg_index['count']:
+                    complete = os.path.getsize(fn) <= seg_index['end_offset']
+                    if complete and start is not None and seg_index['max_ts'] < start:
+                        continue
+                    if complete and end is not None and seg_index['min_ts'] >= end:
+                        continue
+                if self.mmap and fn.endswith(self.segment_ext):
+                    reader = MappedSegmentReader(fn)
+                    for record in reader.iter_records(seg_index, start, end, field_filters):
+                        yield record
+                    continue
+                records = self.iter_segment_records(fn, seg_index, start, end)
+                for record in records:
+                    if match_fields(record, field_filters):
+                        yield record
+    def get_retention_cutoff(self, ts):
+        return self.get_partition_key(ts)
+    def remove_before(self, ts):
+        """Delete partitions that end at or before ``ts``.  Only whole
+        partitions are removed (see :meth:`get_retention_cutoff`)
+        """
+        with self.lock:
+            for key, dirname in list(self.iter_partitions()):
+                if key + self.partition_interval > ts:
+                    break
+                self.close_segment(key)
+                self._indexes.pop(key, None)
+                shutil.rmtree(dirname)
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            shutil.rmtree(self.filename)
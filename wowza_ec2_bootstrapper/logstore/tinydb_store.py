@@ -0,0 +1,148 @@
+import sys
+
+from tinydb import TinyDB, Query
+from tinydb.storages import JSONStorage
+from tinydb.middlewares import CachingMiddleware
+
+from wowza_ec2_bootstrapper.logstore import BaseStore, record_to_dict, RecordParser
+
+class TinyDBStore(BaseStore):
+    """Stores entries in a single TinyDB JSON document
+
+    By default the database is opened and closed for every batch.  With
+    ``persistent=True`` a single handle is kept open, batches are appended
+    directly to its cached table (so the cost of a write depends only on
+    the batch size) and the cache is written according to ``flush_count``
+    (default 10000) and ``flush_interval``.  Each flush writes the whole
+    file, so its cost still grows with the database.
+
+    Each document holds the schema version of its record layout under
+    :attr:`schema_key` so documents written with different layouts are
+    read back with the right fields.
+    """
+    store_name = 'tinydb'
+    concurrent_reads = True
+    default_filename = '~/wowzalog.json.db'
+    schema_key = '_schema'
+    table_name = '_default'
+    def __init__(self, **kwargs):
+        super(TinyDBStore, self).__init__(**kwargs)
+        self.persistent = kwargs.get('persistent', False)
+        if self.persistent and kwargs.get('flush_count') is None:
+            self.flush_count = 10000
+        self._db = None
+        self._db_storage = None
+        self._next_id = None
+    @property
+    def flush_timeout(self):
+        if not self.persistent:
+            return None
+        return self.flush_interval
+    @property
+    def db(self):
+        if self.persistent:
+            self.open()
+            return self._db
+        return TinyDB(self.filename, storage=CachingMiddleware(JSONStorage))
+    def open(self):
+        if not self.persistent or self._db is not None:
+            return
+        # Flushing is handled by flush_count/flush_interval, so keep the
+        # middleware from writing on its own
+        storage = self._db_storage = CachingMiddleware(JSONStorage)
+        storage.WRITE_CACHE_SIZE = sys.maxsize
+        self._db = TinyDB(self.filename, storage=storage)
+        table = storage.read().get(self.table_name, {})
+        self._next_id = max([int(k) for k in table] or [0]) + 1
+    def close(self):
+        with self.lock:
+            db = self._db
+            if db is None:
+                return
+            # if writing the cache fails the handle is kept (with the entries
+            # still counted as pending) so a later close can retry
+            db.close()
+            self._db = None
+            self._db_storage = None
+            self._next_id = None
+            self._unflushed = 0
+    def write_entries(self, records):
+        if self.persistent:
+            super(TinyDBStore, self).write_entries(records)
+            return
+        with self.lock:
+            print 'open db'
+            with self.db as db:
+                db.insert_multiple(self.build_docs(records))
+            print 'close db (%s entries)' % (len(records))
+    def _write_entries(self, records):
+        # Table.insert_multiple rebuilds a Document for every stored row on
+        # each call, so add to the cached data directly instead
+        storage = self._db_storage
+        data = storage.read()
+        table = data.setdefault(self.table_name, {})
+        doc_id = self._next_id
+        for doc in self.build_docs(records):
+            table[str(doc_id)] = doc
+            doc_id += 1
+        self._next_id = doc_id
+        storage.write(data)
+        self._db.clear_cache()
+    def build_docs(self, records):
+        versions = {}
+        docs = []
+        for r in records:
+            version = versions.get(r._fields)
+            if version is None:
+                version = versions[r._fields] = self.get_schema_version(r._fields)
+            doc = record_to_dict(r)
+            doc[self.schema_key] = version
+            docs.append(doc)
+        return docs
+    def _flush(self):
+        self._db_storage.flush()
+        print 'flush db (%s entries)' % (self._unflushed)
+    def remove_before(self, ts):
+        with self.lock:
+            if self.persistent:
+                self.open()
+                self._db.remove(Query().timestamp < ts)
+                self._db_storage.flush()
+                return
+            with self.db as db:
+                db.remove(Query().timestamp < ts)
+    def iter_entries(self, start=None, end=None):
+        # Read a snapshot under the lock so writes only wait for the read,
+        # not for the caller to consume the results
+        with self.lock:
+            if self.persistent:
+                # the shared handle must stay open
+                docs = self.db.all()
+            else:
+                with self.db as db:
+                    docs = db.all()
+        for doc in docs:
+            ts = doc.get('timestamp')
+            if start is not None and ts < start:
+                continue
+            if end is not None and ts >= end:
+                continue
+            yield doc
+    def get_parser(self, doc):
+        version = doc.get(self.schema_key)
+        fields = None
+        if version is not None:
+            fields = self.schemas.get_fields(version)
+        if fields is None:
+            fields = self.field_names
+        if fields is None:
+            fields = sorted(k for k in doc.keys() if k != self.schema_key)
+        return RecordParser(fields)
+    def iter_records(self, start=None, end=None):
+        parsers = {}
+        for doc in self.iter_entries(start, end):
+            version = doc.get(self.schema_key)
+            parser = parsers.get(version)
+            if parser is None:
+                parser = parsers[version] = self.get_parser(doc)
+            yield parser.from_dict(doc)
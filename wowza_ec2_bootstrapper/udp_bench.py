@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+"""Throughput and loss benchmarks for udp_logger
+
+Synthetic Wowza access log lines are sent from one or more sender processes
+at a fixed rate to a receiver running in this process.  For every
+combination of storage backend and receiver mode the sustained ingest rate,
+drop rate, commit latency percentiles and RSS growth are reported.
+
+Example::
+
+    python -m wowza_ec2_bootstrapper.udp_bench --rate 20000 --senders 4 \\
+        --storage tinydb --storage segment --receiver socketserver --receiver batch
+"""
+
+import os
+import time
+import random
+import shutil
+import socket
+import datetime
+import argparse
+import tempfile
+import multiprocessing
+
+from wowza_ec2_bootstrapper import udp_logger
+
+EVENTS = [
+    # (x_event, x_category, weight)
+    ('connect', 'session', 10),
+    ('create', 'stream', 8),
+    ('play', 'stream', 10),
+    ('stop', 'stream', 8),
+    ('destroy', 'stream', 8),
+    ('disconnect', 'session', 10),
+    ('publish', 'stream', 1),
+    ('unpublish', 'stream', 1),
+    ('comment', 'server', 1),
+]
+APPS = ['live', 'vod', 'live-hd', 'events']
+USER_AGENTS = [
+    'WIN 23,0,0,162',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 9_3 like Mac OS X) AppleWebKit/601.1.46',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/50.0',
+    'Lavf/56.40.101',
+    'LNX 9,0,124,2',
+]
+
+def get_rss():
+    """Resident set size of this process in bytes (Linux only)"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+class LogGenerator(object):
+    """Builds tab-separated lines in the layout Wowza sends to the UDP
+    appender using the field list from :func:`udp_logger.get_fields`
+
+    Apps and stream names are chosen with a skewed distribution (a few
+    popular streams and a long tail), events follow typical session
+    ordering frequencies and byte counters grow per client.  Lines are
+    padded through ``x_comment`` to at least ``payload_size`` bytes.
+    """
+    def __init__(self, field_names=None, **kwargs):
+        if field_names is None:
+            field_names = udp_logger.TEST_FIELD_NAMES
+        field_names = udp_logger.get_fields(field_names)
+        self.field_names = [f for f in field_names if f != 'timestamp']
+        self.payload_size = int(kwargs.get('payload_size', 0))
+        self.num_streams = int(kwargs.get('num_streams', 200))
+        self.num_clients = int(kwargs.get('num_clients', 5000))
+        self.random = random.Random(kwargs.get('seed'))
+        self._events = []
+        for event, category, weight in EVENTS:
+            self._events.extend([(event, category)] * weight)
+        self._client_bytes = {}
+        self._index = {f:i for i, f in enumerate(self.field_names)}
+    def choose_stream(self):
+        # paretovariate gives a long tailed popularity distribution
+        i = int(self.random.paretovariate(1.2)) - 1
+        i = min(i, self.num_streams - 1)
+        app = APPS[i % len(APPS)]
+        return app, 'stream%d' % (i)
+    def build_line(self, now=None):
+        if now is None:
+            now = time.time()
+        rnd = self.random
+        dt = datetime.datetime.utcfromtimestamp(now)
+        event, category = rnd.choice(self._events)
+        app, stream = self.choose_stream()
+        client_id = rnd.randint(1, self.num_clients)
+        sc, cs = self._client_bytes.get(client_id, (0, 0))
+        sc += rnd.randint(0, 500000)
+        cs += rnd.randint(0, 5000)
+        self._client_bytes[client_id] = (sc, cs)
+        values = dict(
+            date=dt.strftime('%Y-%m-%d'),
+            time=dt.strftime('%H:%M:%S'),
+            tz='UTC',
+            x_event=event,
+            x_category=category,
+            x_severity='INFO',
+            x_status='200',
+            x_ctx=stream,
+            x_comment='-',
+            x_vhost='_defaultVHost_',
+            x_app=app,
+            x_appinst='_definst_',
+            x_duration='%.3f' % (rnd.expovariate(1 / 300.)),
+            s_ip='10.0.0.1',
+            s_port='1935',
+            s_uri='rtmp://10.0.0.1:1935/%s' % (app),
+            c_ip='192.168.%d.%d' % (client_id // 256 % 256, client_id % 256),
+            c_proto='rtmp',
+            c_referrer='-',
+            c_user_agent=rnd.choice(USER_AGENTS),
+            c_client_id=str(client_id),
+            cs_bytes=str(cs),
+            sc_bytes=str(sc),
+            x_stream_id='1',
+            x_spos='0',
+            cs_stream_bytes=str(cs),
+            sc_stream_bytes=str(sc),
+            x_sname=stream,
+            x_sname_query='-',
+        )
+        line = [values.get(f, '-') for f in self.field_names]
+        if self.payload_size and 'x_comment' in self._index:
+            size = sum(len(v) for v in line) + len(line)
+            if size < self.payload_size:
+                line[self._index['x_comment']] = 'x' * (self.payload_size - size)
+        return '\t'.join(line) + '\n'
+
+def _sender_main(addr, rate, duration, payload_size, seed, result_queue):
+    gen = LogGenerator(payload_size=payload_size, seed=seed)
+    # build a pool of lines up front so generation cost doesn't limit the rate
+    lines = [gen.build_line() for i in range(1000)]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = 0
+    errors = 0
+    start = time.time()
+    end = start + duration
+    interval = .01
+    per_interval = max(int(rate * interval), 1)
+    next_ts = start
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        for i in xrange(per_interval):
+            try:
+                sock.sendto(lines[sent % len(lines)], addr)
+            except socket.error:
+                errors += 1
+            sent += 1
+        next_ts += interval
+        delay = next_ts - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    result_queue.put((sent, errors, time.time() - start))
+
+def run_benchmark(**kwargs):
+    """Run one benchmark and return a dict of results
+
+    :param storage: storage backend name
+    :param receiver: receiver mode (see :data:`udp_logger.SERVER_CLASSES`)
+    :param rate: datagrams per second for each sender
+    :param senders: number of sender processes
+    :param duration: seconds to send for
+    :param payload_size: minimum datagram size
+    :param drain_timeout: seconds to wait for queued entries to be committed
+
+    Any other keyword arguments are passed to :func:`udp_logger.main`.
+    """
+    rate = float(kwargs.pop('rate', 5000))
+    num_senders = int(kwargs.pop('senders', 1))
+    duration = float(kwargs.pop('duration', 10.))
+    payload_size = int(kwargs.pop('payload_size', 0))
+    drain_timeout = float(kwargs.pop('drain_timeout', 60.))
+    tmp_dir = tempfile.mkdtemp(prefix='udp_bench-')
+    kwargs.setdefault('filename', os.path.join(tmp_dir, 'store'))
+    kwargs.setdefault('field_names', udp_logger.TEST_FIELD_NAMES)
+    kwargs.setdefault('port', 0)
+    rss_start = get_rss()
+    server, server_thread = udp_logger.main(**kwargs)
+    db = server.db
+    try:
+        result_queue = multiprocessing.Queue()
+        procs = []
+        for i in range(num_senders):
+            p = multiprocessing.Process(
+                target=_sender_main,
+                args=(server.server_address, rate, duration, payload_size, i, result_queue),
+            )
+            procs.append(p)
+        start = time.time()
+        for p in procs:
+            p.start()
+        results = [result_queue.get() for p in procs]
+        for p in procs:
+            p.join()
+        send_end = time.time()
+        committed = db.metrics.counter('commit.entries')
+        while time.time() - send_end < drain_timeout:
+            if not len(db.queue) and committed.value >= db.accepted:
+                break
+            time.sleep(.1)
+        end = time.time()
+        rss_end = get_rss()
+        sent = sum(r[0] for r in results)
+        received = db.metrics.counter('udp.packets').get_value()
+        latency = db.metrics.histogram('commit.latency').get_value()
+        return dict(
+            storage=kwargs.get('storage') or 'tinydb',
+            receiver=kwargs.get('receiver', 'socketserver'),
+            senders=num_senders,
+            sent=sent,
+            send_rate=sent / (send_end - start),
+            received=received,
+            committed=committed.value,
+            ingest_rate=committed.value / (end - start),
+            drop_rate=1. - (float(committed.value) / sent if sent else 0.),
+            commit_p50=latency['p50'],
+            commit_p90=latency['p90'],
+            commit_p99=latency['p99'],
+            rss_growth=rss_end - rss_start,
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+RESULT_COLUMNS = [
+    ('storage', '%-10s'),
+    ('receiver', '%-12s'),
+    ('sent', '%9d'),
+    ('send_rate', '%10.0f'),
+    ('ingest_rate', '%12.0f'),
+    ('drop_rate', '%9.2f%%'),
+    ('commit_p50', '%10.4f'),
+    ('commit_p99', '%10.4f'),
+    ('rss_growth', '%12d'),
+]
+
+def format_result(result):
+    values = []
+    for key, fmt in RESULT_COLUMNS:
+        value = result[key]
+        if key == 'drop_rate':
+            value *= 100
+        values.append(fmt % value)
+    return ' '.join(values)
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--storage', action='append')
+    p.add_argument('--receiver', action='append')
+    p.add_argument('--rate', type=float, default=5000, help='Datagrams/sec per sender')
+    p.add_argument('--senders', type=int, default=1)
+    p.add_argument('--duration', type=float, default=10.)
+    p.add_argument('--payload-size', type=int, default=0)
+    p.add_argument('--rcvbuf', type=int)
+    args = p.parse_args(argv)
+    storages = args.storage or ['tinydb', 'segment']
+    receivers = args.receiver or sorted(udp_logger.SERVER_CLASSES.keys())
+    print(' '.join([key for key, fmt in RESULT_COLUMNS]))
+    results = []
+    for storage in storages:
+        for receiver in receivers:
+            result = run_benchmark(
+                storage=storage, receiver=receiver, rate=args.rate,
+                senders=args.senders, duration=args.duration,
+                payload_size=args.payload_size, rcvbuf=args.rcvbuf,
+                persistent=True,
+            )
+            results.append(result)
+            print(format_result(result))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/') or '/'
+        route = self.server.routes.get(path)
+        if route is None:
+            self.send_error(404)
+            return
+        content_type, body = route()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+class JSONHTTPServer(HTTPServer):
+    """Small local HTTP server for status endpoints
+
+    Routes are added with :meth:`add_json_route` (the callable's return value
+    is served as JSON) or :meth:`add_route` (the callable returns a
+    ``(content_type, body)`` tuple).
+    """
+    def __init__(self, **kwargs):
+        host = kwargs.get('host', '127.0.0.1')
+        port = int(kwargs.get('port', 8882))
+        HTTPServer.__init__(self, (host, port), JSONRequestHandler)
+        self.routes = {}
+        self.server_thread = None
+    def add_route(self, path, callback):
+        self.routes[path] = callback
+    def add_json_route(self, path, callback):
+        def route():
+            return 'application/json', json.dumps(callback(), indent=2)
+        self.add_route(path, route)
+    def start(self):
+        t = self.server_thread = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+    def stop(self):
+        if self.server_thread is None:
+            return
+        self.shutdown()
+        self.server_close()
+        self.server_thread = None
@@ -2,18 +2,29 @@
 
 import os
 import time
+import errno
+import socket
+import select
+import signal
+import struct
 import datetime
+import multiprocessing
 import threading
 import collections
 import traceback
 from SocketServer import UDPServer, BaseRequestHandler
 
-from tinydb import TinyDB
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
+from wowza_ec2_bootstrapper import logstore
+from wowza_ec2_bootstrapper.udp_http import JSONHTTPServer
+from wowza_ec2_bootstrapper.udp_stats import StreamStats
+from wowza_ec2_bootstrapper.udp_pipeline import Pipeline
+from wowza_ec2_bootstrapper.udp_sinks import build_sinks
+from wowza_ec2_bootstrapper.udp_metrics import MetricsRegistry, StatsdPusher, SIZE_BUCKETS
 
 WOWZA_ROOT = '/usr/local/WowzaStreamingEngine'
 
+TEST_FIELD_NAMES = 'date,time,tz,x_event,x_category,x_severity,x_status,x_ctx,x_comment,x_vhost,x_app,x_appinst,x_duration,s_ip,s_port,s_uri,c_ip,c_proto,c_referrer,c_user_agent,c_client_id,cs_bytes,sc_bytes,x_stream_id,x_spos,cs_stream_bytes,sc_stream_bytes,x_sname,x_sname_query,x_file_name,x_file_ext,x_file_size,x_file_length,x_suri,x_suri_stem,x_suri_query,cs_uri_stem,cs_uri_query'
+
 def get_field_names():
     logconf = os.path.join(WOWZA_ROOT, 'conf', 'log4j.properties')
     with open(logconf, 'r') as f:
@@ -41,43 +52,383 @@ def get_fields(field_names=None):
     
 class DbLogger(object):
     def __init__(self, **kwargs):
-        filename = kwargs.get('filename')
-        if filename is None:
-            filename = os.path.expanduser('~/wowzalog.json.db')
         self.field_names = get_fields(kwargs.get('field_names'))
-        self.filename = filename
+        self.parser = logstore.RecordParser(self.field_names)
+        store_kwargs = kwargs.copy()
+        store_kwargs['field_names'] = self.field_names
+        self.store = logstore.build_store(**store_kwargs)
+        self.filename = self.store.filename
+        self.schema_version = self.store.get_schema_version(self.field_names)
+        self.schema_mismatches = 0
+        # Only layouts read from log4j.properties can be reloaded
+        self.reload_fields = kwargs.get('reload_fields', kwargs.get('field_names') is None)
+        self.reload_interval = float(kwargs.get('reload_interval', 10.))
+        self._last_reload = None
         self.queue = collections.deque()
+        self.max_queue = int(kwargs.get('max_queue') or 0)
+        self.overflow = kwargs.get('overflow', 'drop_newest')
+        if self.overflow not in ['drop_newest', 'drop_oldest', 'spill']:
+            raise ValueError('Unknown overflow policy %s' % (self.overflow))
+        spill_filename = kwargs.get('spill_filename')
+        if spill_filename is None:
+            spill_filename = '.'.join([self.filename, 'spill'])
+        self.spill_filename = spill_filename
+        self._spill_fh = None
+        self._spill_pending = (
+            os.path.exists(spill_filename) or
+            os.path.exists('.'.join([spill_filename, 'replay']))
+        )
+        self.accepted = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.restart_on_error = kwargs.get('restart_on_error', True)
+        self.max_retries = int(kwargs.get('max_retries', 3))
+        self._retry_count = 0
+        self.pipeline = None
+        if kwargs.get('pipeline'):
+            self.pipeline = Pipeline(kwargs.get('pipeline'))
+        self.stats = None
+        if kwargs.get('stats'):
+            self.stats = StreamStats(
+                window=kwargs.get('stats_window', 300.),
+                bucket_size=kwargs.get('stats_bucket_size', 10.),
+                max_streams=kwargs.get('stats_max_streams', 1000),
+                max_sessions=kwargs.get('stats_max_sessions', 100000),
+            )
+        self.sinks = []
+        if kwargs.get('sinks'):
+            self.sinks = build_sinks(
+                kwargs.get('sinks'),
+                field_names=self.field_names,
+            )
+            for sink in self.sinks:
+                sink.start()
+        self.journal = None
+        if kwargs.get('journal'):
+            if self.overflow == 'drop_oldest':
+                raise ValueError('journal cannot be used with drop_oldest overflow')
+            journal_filename = kwargs.get('journal_filename')
+            if journal_filename is None:
+                journal_filename = '.'.join([self.filename, 'journal'])
+            self.journal = logstore.Journal(
+                journal_filename,
+                sync_interval=kwargs.get('journal_sync_interval', 1.),
+            )
+            self.replay_journal()
+            self._journal_base = self.journal.seq
+            self._committed = 0
+        self.retention = None
+        if kwargs.get('retention_days'):
+            policy = logstore.RetentionPolicy(
+                self.store,
+                raw_days=kwargs.get('retention_days'),
+                aggregate_days=kwargs.get('retention_aggregate_days'),
+                aggregate_interval=kwargs.get('retention_aggregate_interval', 60),
+            )
+            self.retention = logstore.RetentionTask(
+                policy, interval=kwargs.get('retention_interval', 3600.),
+            )
+        self.metrics = MetricsRegistry()
+        self.init_metrics()
+        self.http_server = None
+        if kwargs.get('http_port'):
+            self.http_server = JSONHTTPServer(
+                host=kwargs.get('http_host', '127.0.0.1'),
+                port=kwargs.get('http_port'),
+            )
+            self.http_server.add_json_route('/metrics', self.metrics.snapshot)
+            if self.stats is not None:
+                self.http_server.add_json_route('/stats', self.stats.snapshot)
+            self.http_server.start()
+        self.statsd = None
+        if kwargs.get('statsd_host'):
+            self.statsd = StatsdPusher(
+                self.metrics,
+                host=kwargs.get('statsd_host'),
+                port=kwargs.get('statsd_port', 8125),
+                prefix=kwargs.get('statsd_prefix', 'udp_logger'),
+                interval=kwargs.get('statsd_interval', 10.),
+            )
+            self.statsd.start()
         self.need_write = threading.Event()
         self.entry_lock = threading.Lock()
+        if self._spill_pending:
+            self.need_write.set()
         self.db_thread = DbThread(self)
         self.db_thread.start()
         if self.db_thread.exception is None:
             self.db_thread._running.wait()
+        if self.retention is not None:
+            self.retention.start()
     @property
     def db(self):
-        return TinyDB(self.filename, storage=CachingMiddleware(JSONStorage))
+        return self.store.db
+    def init_metrics(self):
+        m = self.metrics
+        m.counter('queue.accepted', func=lambda: self.accepted)
+        m.counter('queue.dropped', func=lambda: self.dropped)
+        m.counter('queue.spilled', func=lambda: self.spilled)
+        m.gauge('queue.depth', func=lambda: len(self.queue))
+        m.gauge('store.pending', func=lambda: self.store.pending_count)
+        if self.pipeline is not None:
+            m.counter('pipeline.records_in', func=lambda: self.pipeline.records_in)
+            m.counter('pipeline.records_out', func=lambda: self.pipeline.records_out)
+        for sink in self.sinks:
+            self.init_sink_metrics(sink)
+        if self.retention is not None:
+            m.counter('retention.compacted', func=lambda: self.retention.compacted)
+            m.counter('retention.errors', func=lambda: self.retention.errors)
+        m.counter('ingest.schema_mismatch', func=lambda: self.schema_mismatches)
+        m.gauge('ingest.schema_version', func=lambda: self.schema_version)
+        m.gauge('writer.alive', func=self.get_writer_health)
+        m.gauge('writer.restarts', func=lambda: self.db_thread.restarts)
+        m.counter('commit.entries')
+        m.histogram('commit.batch_size', buckets=SIZE_BUCKETS)
+        m.histogram('commit.latency')
+    def init_sink_metrics(self, sink):
+        m = self.metrics
+        prefix = 'sink.%s' % (sink.name)
+        m.counter('.'.join([prefix, 'sent']), func=lambda: sink.sent)
+        m.counter('.'.join([prefix, 'dropped']), func=lambda: sink.dropped)
+        m.counter('.'.join([prefix, 'errors']), func=lambda: sink.errors)
+        m.gauge('.'.join([prefix, 'depth']), func=lambda: len(sink.queue))
+    def get_writer_health(self):
+        t = self.db_thread
+        return int(t.is_alive() and t._running.is_set())
+    @property
+    def wait_timeout(self):
+        timeout = self.store.flush_timeout
+        if self.journal is not None:
+            if timeout is None or timeout > self.journal.sync_interval:
+                timeout = self.journal.sync_interval
+        return timeout
+    def flush(self):
+        self.store.flush()
     def stop(self):
+        if self.http_server is not None:
+            self.http_server.stop()
+        if self.statsd is not None:
+            self.statsd.stop()
+        if self.retention is not None:
+            self.retention.stop()
         self.db_thread.stop()
+        self.store.close()
+        for sink in self.sinks:
+            sink.stop()
+        if self.journal is not None:
+            self.checkpoint_journal()
+            self.journal.close()
+        if self._spill_fh is not None:
+            self._spill_fh.close()
+            self._spill_fh = None
+    def replay_journal(self):
+        """Write any journaled entries from a previous run that did not
+        reach storage
+        """
+        journal = self.journal
+        count = 0
+        batch = []
+        last_seq = None
+        for seq, line, ts in journal.iter_uncommitted():
+            batch.append((line, ts))
+            last_seq = seq
+            if len(batch) >= self.store.flush_count:
+                self.commit_entries(*batch)
+                count += len(batch)
+                batch = []
+        if len(batch):
+            self.commit_entries(*batch)
+            count += len(batch)
+        if last_seq is None:
+            return 0
+        self.store.flush()
+        journal.checkpoint(last_seq)
+        print('replayed %s journal entries' % (count))
+        return count
+    def checkpoint_journal(self):
+        journal = self.journal
+        if journal is None:
+            return
+        journal.sync()
+        if self.store.pending_count:
+            # Entries are only known to be stored once everything written
+            # has been flushed (pipeline stages may have dropped some)
+            return
+        journal.checkpoint(self._journal_base + self._committed)
     def add_entry(self, line, ts=None):
+        self.add_entries([line], ts)
+    def add_entries(self, lines, ts=None):
+        if not len(lines):
+            return
         if ts is None:
             ts = time.time()
         t = self.db_thread
-        if not t._running.is_set() and self.need_write.is_set():
-            return
+        entries = self.split_entries(lines, ts)
         with self.entry_lock:
-            self.queue.append((line, ts))
+            if not t._running.is_set() and self.need_write.is_set():
+                self.dropped += len(entries)
+                return
+            if self.max_queue:
+                room = self.max_queue - len(self.queue)
+                if len(entries) > room:
+                    entries = self.handle_overflow(entries, max(room, 0))
+            if self.journal is not None:
+                self.journal.append(entries)
+            self.queue.extend(entries)
+            self.accepted += len(entries)
             self.need_write.set()
+    def split_entries(self, lines, ts):
+        """Build ``(line, ts)`` entries holding one line each.  A datagram
+        or frame may carry several newline separated lines (as batched by a
+        forwarding sink) and the journal and spill file store one entry per
+        line
+        """
+        entries = []
+        for line in lines:
+            if '\n' in line.rstrip('\n'):
+                entries.extend((l, ts) for l in line.split('\n') if l)
+            else:
+                entries.append((line, ts))
+        return entries
+    def handle_overflow(self, entries, room):
+        """Apply the overflow policy to a batch that does not fit in the
+        queue.  Called with :attr:`entry_lock` held.  Returns the entries
+        that should still be queued
+        """
+        policy = self.overflow
+        if policy == 'drop_oldest':
+            excess = len(self.queue) + len(entries) - self.max_queue
+            n = min(excess, len(self.queue))
+            for i in xrange(n):
+                self.queue.popleft()
+            self.dropped += excess
+            return entries[excess - n:]
+        if policy == 'spill':
+            self.spill_entries(entries[room:])
+            return entries[:room]
+        self.dropped += len(entries) - room
+        return entries[:room]
+    def spill_entries(self, entries):
+        fh = self._spill_fh
+        if fh is None:
+            fh = self._spill_fh = open(self.spill_filename, 'ab')
+        fh.write(logstore.format_raw_entries(entries))
+        fh.flush()
+        self.spilled += len(entries)
+        self._spill_pending = True
+    def replay_spill(self):
+        """Move spilled entries into storage once the queue has drained.
+        Called from the :class:`DbThread`
+        """
+        replay_fn = '.'.join([self.spill_filename, 'replay'])
+        with self.entry_lock:
+            if self._spill_pending:
+                if self._spill_fh is not None:
+                    self._spill_fh.close()
+                    self._spill_fh = None
+                if os.path.exists(self.spill_filename) and not os.path.exists(replay_fn):
+                    os.rename(self.spill_filename, replay_fn)
+                self._spill_pending = os.path.exists(self.spill_filename)
+        if not os.path.exists(replay_fn):
+            return 0
+        count = 0
+        batch = []
+        with open(replay_fn, 'rb') as f:
+            for s in f:
+                batch.append(logstore.parse_raw_entry(s))
+                if len(batch) >= self.store.flush_count:
+                    self.commit_entries(*batch)
+                    count += len(batch)
+                    batch = []
+        if len(batch):
+            self.commit_entries(*batch)
+            count += len(batch)
+        os.remove(replay_fn)
+        print('replayed %s spilled entries' % (count))
+        return count
+    def get_counters(self):
+        with self.entry_lock:
+            return dict(
+                accepted=self.accepted,
+                dropped=self.dropped,
+                spilled=self.spilled,
+                queue_depth=len(self.queue),
+            )
+    def build_entries(self, entries):
+        parser = self.parser
+        mismatched = parser.mismatched
+        records = parser.parse_entries(entries)
+        if parser.mismatched != mismatched:
+            self.schema_mismatches += parser.mismatched - mismatched
+            if self.reload_field_names():
+                records = self.parser.parse_entries(entries)
+        return records
+    def reload_field_names(self):
+        """Re-read the field layout from log4j.properties after lines that
+        do not fit the current layout were received.  If it has changed,
+        the new layout is used (and registered as a new schema version) for
+        all following entries.  Returns ``True`` if the layout changed
+        """
+        if not self.reload_fields:
+            return False
+        now = time.time()
+        if self._last_reload is not None and now - self._last_reload < self.reload_interval:
+            return False
+        self._last_reload = now
+        try:
+            field_names = get_field_names()
+        except (IOError, OSError):
+            traceback.print_exc()
+            return False
+        if field_names is None:
+            return False
+        field_names = get_fields(field_names)
+        if tuple(field_names) == self.parser.field_names:
+            return False
+        print('field layout changed: %s' % (','.join(field_names)))
+        self.field_names = field_names
+        self.parser = logstore.RecordParser(field_names)
+        self.store.field_names = field_names
+        self.schema_version = self.store.get_schema_version(field_names)
+        return True
     def commit_entries(self, *entries):
-        field_names = self.field_names
-        ts_index = field_names.index('timestamp')
-        print 'open db'
-        with self.db as db:
-            for line, ts in entries:
-                entry = line.strip('\n').split('\t')
-                entry.insert(ts_index, ts)
-                entry = {fname:val for fname, val in zip(field_names, entry)}
-                db.insert(entry)
-        print 'close db (%s entries)' % (len(entries))
+        records = self.build_entries(entries)
+        if self.pipeline is not None:
+            stored = self.pipeline.process(records)
+        else:
+            stored = records
+        if len(stored):
+            self.store.write_entries(stored)
+        for sink in self.sinks:
+            if sink.raw_records:
+                sink.put(records)
+            elif len(stored):
+                sink.put(stored)
+        if self.stats is not None:
+            self.stats.add_records(records)
+    def entries_committed(self, entries):
+        """Called by the :class:`DbThread` after a batch from the queue has
+        been written
+        """
+        self._retry_count = 0
+        if self.journal is not None:
+            self._committed += len(entries)
+    def entries_failed(self, entries):
+        """Called by the :class:`DbThread` when a batch from the queue could
+        not be written.  The batch is returned to the front of the queue
+        unless it has already failed ``max_retries`` times
+        """
+        self._retry_count += 1
+        with self.entry_lock:
+            if self._retry_count > self.max_retries:
+                print('dropping %s entries after %s retries' % (len(entries), self.max_retries))
+                self._retry_count = 0
+                self.dropped += len(entries)
+                if self.journal is not None:
+                    self._committed += len(entries)
+                return
+            self.queue.extendleft(reversed(entries))
+            self.need_write.set()
         
 class DbThread(threading.Thread):
     def __init__(self, db_logger):
@@ -85,57 +436,109 @@ class DbThread(threading.Thread):
         self.db_logger = db_logger
         self._running = threading.Event()
         self._stopped = threading.Event()
+        self._wake = threading.Event()
         self.exception = None
+        self.restarts = 0
+        self._errors = 0
     def run(self):
         self._running.set()
-        need_write = self.db_logger.need_write
+        db_logger = self.db_logger
+        need_write = db_logger.need_write
+        store = db_logger.store
         while self._running.is_set():
-            need_write.wait()
+            need_write.wait(db_logger.wait_timeout)
             if not self._running.is_set():
                 break
             try:
                 self.commit_entries()
+                store.check_flush()
+                db_logger.checkpoint_journal()
+                self._errors = 0
             except Exception as e:
                 self.exception = e
                 self.exception_tb = traceback.format_exc()
-                self._running.clear()
                 print(self.exception_tb)
+                if db_logger.restart_on_error:
+                    self.restart_writer()
+                else:
+                    self._running.clear()
         print('DbThread stopped')
         self._stopped.set()
+    def restart_writer(self):
+        self.restarts += 1
+        self._errors += 1
+        delay = min(2 ** (self._errors - 1), 30)
+        print('DbThread restarting writer in %s seconds' % (delay))
+        try:
+            self.db_logger.store.close()
+            self.db_logger.checkpoint_journal()
+        except Exception:
+            print(traceback.format_exc())
+        self._wake.wait(delay)
     def stop(self):
         print('DbThread stopping..')
         self._running.clear()
+        self._wake.set()
         self.db_logger.need_write.set()
         self._stopped.wait()
     def commit_entries(self):
         db = self.db_logger
+        metrics = db.metrics
+        entry_count = metrics.counter('commit.entries')
+        batch_size = metrics.histogram('commit.batch_size')
+        latency = metrics.histogram('commit.latency')
         def get_entries():
-            entries = []
-            while True:
-                with db.entry_lock:
-                    try:
-                        entry = db.queue.popleft()
-                    except IndexError:
-                        entry = None
-                    if entry is None:
-                        if self._running.is_set():
-                            db.need_write.clear()
-                        break
-                    else:
-                        entries.append(entry)
+            with db.entry_lock:
+                entries = list(db.queue)
+                db.queue.clear()
+                if not len(entries) and not db._spill_pending:
+                    if self._running.is_set():
+                        db.need_write.clear()
             return entries
         while True:
             entries = get_entries()
             if not len(entries):
                 break
-            db.commit_entries(*entries)
+            batch_size.observe(len(entries))
+            start_ts = time.time()
+            try:
+                db.commit_entries(*entries)
+            except Exception:
+                db.entries_failed(entries)
+                raise
+            latency.observe(time.time() - start_ts)
+            entry_count.inc(len(entries))
+            db.entries_committed(entries)
+        if db._spill_pending:
+            db.replay_spill()
         
+def set_rcvbuf(sock, rcvbuf):
+    if not rcvbuf:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(rcvbuf))
+
+def set_reuse_port(sock, reuse_port):
+    if not reuse_port:
+        return
+    # SO_REUSEPORT is Linux value 15 when the socket module does not define it
+    opt = getattr(socket, 'SO_REUSEPORT', 15)
+    sock.setsockopt(socket.SOL_SOCKET, opt, 1)
+
 class WowzaUDPServer(UDPServer):
     def __init__(self, **kwargs):
         host = kwargs.get('host', '127.0.0.1')
         port = int(kwargs.get('port', 8881))
+        self.rcvbuf = kwargs.get('rcvbuf')
+        self.reuse_port = kwargs.get('reuse_port')
+        if kwargs.get('tcp_port') is not None:
+            raise ValueError('tcp_port requires the batch receiver')
         UDPServer.__init__(self, (host, port), WowzaHandler)
         self.db = DbLogger(**kwargs)
+        self.packet_count = self.db.metrics.counter('udp.packets')
+    def server_bind(self):
+        set_rcvbuf(self.socket, self.rcvbuf)
+        set_reuse_port(self.socket, self.reuse_port)
+        UDPServer.server_bind(self)
     def add_entry(self, line, ts=None):
         self.db.add_entry(line, ts)
     def server_close(self):
@@ -146,10 +549,268 @@ class WowzaHandler(BaseRequestHandler):
     def handle(self):
         now = time.time()
         data = self.request[0]
+        self.server.packet_count.inc()
         self.server.add_entry(data, ts=now)
         
+class TCPConnection(object):
+    """Buffers data read from a TCP log connection and splits it into
+    frames.
+
+    ``framing`` is either ``'newline'`` (one line per frame, as sent by a
+    log4j socket appender) or ``'length'`` (each frame prefixed by its size
+    as a 4 byte big-endian unsigned int).
+    """
+    length_prefix = struct.Struct('!I')
+    def __init__(self, sock, address, framing='newline', max_frame=1048576):
+        if framing not in ['newline', 'length']:
+            raise ValueError('Unknown framing %s' % (framing))
+        self.socket = sock
+        self.address = address
+        self.framing = framing
+        self.max_frame = max_frame
+        self.buffer = ''
+    def fileno(self):
+        return self.socket.fileno()
+    def read(self, bufsize=65536):
+        """Read available data and return the complete frames received.
+
+        Returns ``None`` once the peer has closed the connection (any
+        unterminated trailing line is returned as a frame first).
+        """
+        frames = []
+        while True:
+            try:
+                data = self.socket.recv(bufsize)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if not data:
+                if self.framing == 'newline' and self.buffer.strip():
+                    frames.append(self.buffer.rstrip('\r'))
+                self.buffer = ''
+                if len(frames):
+                    return frames
+                return None
+            self.buffer += data
+            if len(data) < bufsize:
+                break
+        if self.framing == 'newline':
+            frames.extend(self.split_lines())
+        else:
+            frames.extend(self.split_length())
+        return frames
+    def split_lines(self):
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > self.max_frame:
+            raise ValueError('Frame exceeds %d bytes' % (self.max_frame))
+        return [l.rstrip('\r') for l in lines if l.strip()]
+    def split_length(self):
+        frames = []
+        buf = self.buffer
+        offset = 0
+        hsize = self.length_prefix.size
+        while len(buf) - offset >= hsize:
+            size = self.length_prefix.unpack_from(buf, offset)[0]
+            if size > self.max_frame:
+                raise ValueError('Frame exceeds %d bytes' % (self.max_frame))
+            if len(buf) - offset - hsize < size:
+                break
+            start = offset + hsize
+            frames.append(buf[start:start + size])
+            offset = start + size
+        self.buffer = buf[offset:]
+        return frames
+    def close(self):
+        self.socket.close()
+
+POLL_MASK = select.POLLIN | select.POLLPRI
+
+class WowzaBatchUDPServer(object):
+    """Non-blocking UDP receiver that reads every pending datagram on each
+    pass of its poll loop and hands them to the :class:`DbLogger` queue as
+    a single batch.
+
+    Accepts the same keyword arguments as :class:`WowzaUDPServer` plus
+    ``max_batch``, the most datagrams read per pass.
+
+    If ``tcp_port`` is given, a TCP listener is served from the same loop
+    (on ``tcp_host``, defaulting to ``host``).  Frames from any number of
+    connections are fed to the same queue.  See :class:`TCPConnection` for
+    the ``tcp_framing`` and ``tcp_max_frame`` options.  Connections beyond
+    ``tcp_max_connections`` are closed as soon as they are accepted.
+    """
+    max_packet_size = 65535
+    def __init__(self, **kwargs):
+        host = kwargs.get('host', '127.0.0.1')
+        port = int(kwargs.get('port', 8881))
+        self.max_batch = int(kwargs.get('max_batch', 1024))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        set_rcvbuf(self.socket, kwargs.get('rcvbuf'))
+        set_reuse_port(self.socket, kwargs.get('reuse_port'))
+        self.socket.bind((host, port))
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.tcp_socket = None
+        self.tcp_address = None
+        self.tcp_framing = kwargs.get('tcp_framing', 'newline')
+        self.tcp_max_frame = int(kwargs.get('tcp_max_frame', 1048576))
+        self.tcp_max_connections = int(kwargs.get('tcp_max_connections', 1000))
+        self.connections = {}
+        # poll has no limit on descriptor numbers (unlike select)
+        self.poller = select.poll()
+        self.poller.register(self.socket, POLL_MASK)
+        if kwargs.get('tcp_port') is not None:
+            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            set_reuse_port(self.tcp_socket, kwargs.get('reuse_port'))
+            self.tcp_socket.bind((
+                kwargs.get('tcp_host', host), int(kwargs.get('tcp_port')),
+            ))
+            self.tcp_socket.listen(int(kwargs.get('tcp_backlog', 128)))
+            self.tcp_socket.setblocking(0)
+            self.tcp_address = self.tcp_socket.getsockname()
+            self.poller.register(self.tcp_socket, POLL_MASK)
+        self._running = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self.db = DbLogger(**kwargs)
+        self.packet_count = self.db.metrics.counter('udp.packets')
+        self.error_count = self.db.metrics.counter('udp.errors')
+        self.read_batch_size = self.db.metrics.histogram(
+            'udp.read_batch_size', buckets=SIZE_BUCKETS,
+        )
+        if self.tcp_socket is not None:
+            m = self.db.metrics
+            self.tcp_frame_count = m.counter('tcp.frames')
+            self.tcp_accept_count = m.counter('tcp.accepted')
+            self.tcp_error_count = m.counter('tcp.errors')
+            self.tcp_reject_count = m.counter('tcp.rejected')
+            m.gauge('tcp.connections', func=lambda: len(self.connections))
+    def add_entry(self, line, ts=None):
+        self.db.add_entry(line, ts)
+    def serve_forever(self, poll_interval=.5):
+        self._stopped.clear()
+        self._running.set()
+        udp_fd = self.socket.fileno()
+        tcp_fd = None
+        if self.tcp_socket is not None:
+            tcp_fd = self.tcp_socket.fileno()
+        try:
+            while self._running.is_set():
+                try:
+                    events = self.poller.poll(poll_interval * 1000)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    self.handle_event(fd, udp_fd, tcp_fd)
+        finally:
+            self._stopped.set()
+    def handle_event(self, fd, udp_fd, tcp_fd):
+        """Dispatch a ready descriptor.  Errors are logged and counted so
+        one failed batch (e.g. the journal hitting a full disk) does not
+        stop the receive loop
+        """
+        try:
+            if fd == udp_fd:
+                self.handle_read()
+            elif fd == tcp_fd:
+                self.handle_accept()
+            else:
+                conn = self.connections.get(fd)
+                if conn is not None:
+                    self.handle_tcp_read(conn)
+        except Exception:
+            self.error_count.inc()
+            print('receive error\n%s' % (traceback.format_exc()))
+    def handle_read(self):
+        now = time.time()
+        recv = self.socket.recv
+        bufsize = self.max_packet_size
+        lines = []
+        while len(lines) < self.max_batch:
+            try:
+                data = recv(bufsize)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            lines.append(data)
+        self.packet_count.inc(len(lines))
+        self.read_batch_size.observe(len(lines))
+        self.db.add_entries(lines, now)
+    def handle_accept(self):
+        while True:
+            try:
+                sock, address = self.tcp_socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    print('accept failed: %s' % (e))
+                    self.tcp_error_count.inc()
+                    break
+                raise
+            if len(self.connections) >= self.tcp_max_connections:
+                sock.close()
+                self.tcp_reject_count.inc()
+                continue
+            sock.setblocking(0)
+            self.connections[sock.fileno()] = TCPConnection(
+                sock, address,
+                framing=self.tcp_framing,
+                max_frame=self.tcp_max_frame,
+            )
+            self.poller.register(sock, POLL_MASK)
+            self.tcp_accept_count.inc()
+    def handle_tcp_read(self, conn):
+        now = time.time()
+        try:
+            frames = conn.read()
+        except Exception:
+            print('closing %s: %s' % (conn.address, traceback.format_exc()))
+            self.tcp_error_count.inc()
+            frames = None
+        if frames is None:
+            self.close_connection(conn)
+            return
+        if len(frames):
+            self.tcp_frame_count.inc(len(frames))
+            self.db.add_entries(frames, now)
+    def close_connection(self, conn):
+        fd = conn.fileno()
+        self.connections.pop(fd, None)
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+        conn.close()
+    def shutdown(self):
+        self._running.clear()
+        self._stopped.wait()
+    def server_close(self):
+        self.socket.close()
+        if self.tcp_socket is not None:
+            for conn in self.connections.values():
+                self.close_connection(conn)
+            self.tcp_socket.close()
+        self.db.stop()
+
+SERVER_CLASSES = {
+    'socketserver':WowzaUDPServer,
+    'batch':WowzaBatchUDPServer,
+}
+
 def main(**kwargs):
-    server = WowzaUDPServer(**kwargs)
+    receiver = kwargs.get('receiver')
+    if receiver is None:
+        # the TCP listener is only served by the batch receiver's loop
+        receiver = 'batch' if kwargs.get('tcp_port') is not None else 'socketserver'
+    server_cls = SERVER_CLASSES[receiver]
+    server = server_cls(**kwargs)
     server_thread = threading.Thread(target=server.serve_forever)
     server_thread.daemon = True
     server_thread.start()
@@ -166,10 +827,123 @@ def main_loop(**kwargs):
     server.server_close()
     return server, server_thread
 
+def _worker_main(**kwargs):
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt()
+    # The supervisor handles SIGINT and stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    main_loop(**kwargs)
+
+class WorkerSupervisor(object):
+    """Runs ``workers`` receiver processes bound to the same port using
+    SO_REUSEPORT so the kernel spreads datagrams across them.
+
+    Each worker writes to its own shard of the store (see
+    :func:`logstore.get_shard_filename`) and serves HTTP (if ``http_port``
+    is set) on ``http_port + shard``.  If ``merge`` is set, the shards are
+    merged into the main store once all workers have stopped.
+
+    Workers that exit are restarted after ``restart_delay`` seconds,
+    doubling for each consecutive failure up to ``max_restart_delay``.  A
+    worker that ran for at least ``max_restart_delay`` seconds is restarted
+    immediately.
+    """
+    def __init__(self, **kwargs):
+        self.num_workers = int(kwargs.pop('workers', multiprocessing.cpu_count()))
+        self.merge = kwargs.pop('merge', False)
+        self.restart_delay = float(kwargs.pop('restart_delay', 1.))
+        self.max_restart_delay = float(kwargs.pop('max_restart_delay', 60.))
+        kwargs['reuse_port'] = True
+        self.filename = logstore.BaseStore.get_filename(**kwargs)
+        self.kwargs = kwargs
+        self.workers = []
+        self._started = {}
+        self._failures = {}
+        self._restart_at = {}
+    def get_worker_kwargs(self, shard):
+        kwargs = self.kwargs.copy()
+        kwargs['filename'] = logstore.get_shard_filename(self.filename, shard)
+        if kwargs.get('http_port'):
+            kwargs['http_port'] = int(kwargs['http_port']) + shard
+        return kwargs
+    def start_worker(self, shard):
+        p = multiprocessing.Process(
+            target=_worker_main,
+            kwargs=self.get_worker_kwargs(shard),
+            name='udp_logger-%d' % (shard),
+        )
+        p.daemon = True
+        p.start()
+        self._started[shard] = time.time()
+        return p
+    def start(self):
+        for shard in range(self.num_workers):
+            self.workers.append(self.start_worker(shard))
+    def get_restart_delay(self, shard, now):
+        if now - self._started[shard] >= self.max_restart_delay:
+            failures = 0
+        else:
+            failures = self._failures.get(shard, 0) + 1
+        self._failures[shard] = failures
+        if not failures:
+            return 0.
+        return min(self.restart_delay * 2 ** (failures - 1), self.max_restart_delay)
+    def check_workers(self, now=None):
+        if now is None:
+            now = time.time()
+        for shard, p in enumerate(self.workers):
+            if p.is_alive():
+                continue
+            restart_at = self._restart_at.get(shard)
+            if restart_at is None:
+                delay = self.get_restart_delay(shard, now)
+                restart_at = self._restart_at[shard] = now + delay
+                print('worker %s exited (%s), restarting in %ss' % (shard, p.exitcode, delay))
+            if now < restart_at:
+                continue
+            del self._restart_at[shard]
+            self.workers[shard] = self.start_worker(shard)
+    def stop(self):
+        for p in self.workers:
+            if p.is_alive():
+                p.terminate()
+        for p in self.workers:
+            p.join()
+        if self.merge:
+            self.merge_shards()
+    def merge_shards(self):
+        sources = []
+        for shard in range(self.num_workers):
+            kwargs = self.get_worker_kwargs(shard)
+            kwargs['field_names'] = get_fields(kwargs.get('field_names'))
+            sources.append(logstore.build_store(**kwargs))
+        kwargs = self.kwargs.copy()
+        kwargs['filename'] = self.filename
+        kwargs['field_names'] = get_fields(kwargs.get('field_names'))
+        dest = logstore.build_store(**kwargs)
+        count = logstore.merge_stores(sources, dest)
+        for store in sources:
+            store.remove()
+        print('merged %s entries into %s' % (count, self.filename))
+        return count
+
+def supervisor_loop(**kwargs):
+    supervisor = WorkerSupervisor(**kwargs)
+    supervisor.start()
+    while True:
+        try:
+            time.sleep(1.)
+            supervisor.check_workers()
+        except KeyboardInterrupt:
+            break
+    supervisor.stop()
+    return supervisor
+
 def test(test_sock=False, timeout=.2, **kwargs):
     import socket
     num_entries = 30
-    kwargs.setdefault('field_names', 'date,time,tz,x_event,x_category,x_severity,x_status,x_ctx,x_comment,x_vhost,x_app,x_appinst,x_duration,s_ip,s_port,s_uri,c_ip,c_proto,c_referrer,c_user_agent,c_client_id,cs_bytes,sc_bytes,x_stream_id,x_spos,cs_stream_bytes,sc_stream_bytes,x_sname,x_sname_query,x_file_name,x_file_ext,x_file_size,x_file_length,x_suri,x_suri_stem,x_suri_query,cs_uri_stem,cs_uri_query')
+    kwargs.setdefault('field_names', TEST_FIELD_NAMES)
     server, server_thread = main(**kwargs)
     def build_entry(i):
         ts = time.time()
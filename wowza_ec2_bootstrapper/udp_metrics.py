@@ -0,0 +1,225 @@
+import time
+import socket
+import bisect
+import threading
+
+# Upper bounds (in seconds) for latency histograms
+LATENCY_BUCKETS = [
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+]
+# Upper bounds for batch size histograms
+SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+class Counter(object):
+    """Monotonic counter.  Updates are a single attribute increment so they
+    can be left on the hot path.  Each counter should only be incremented
+    from one thread.  If ``func`` is given, the value is read from it
+    instead (for counts that are already kept elsewhere)
+    """
+    metric_type = 'counter'
+    def __init__(self, name, func=None):
+        self.name = name
+        self.func = func
+        self.value = 0
+    def inc(self, n=1):
+        self.value += n
+    def get_value(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+class Gauge(object):
+    """Point in time value, either set directly or read from ``func`` when
+    the metrics are collected
+    """
+    metric_type = 'gauge'
+    def __init__(self, name, func=None):
+        self.name = name
+        self.func = func
+        self.value = 0
+    def set(self, value):
+        self.value = value
+    def get_value(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+class Histogram(object):
+    """Fixed bucket histogram
+
+    ``buckets`` are the upper bounds of each bucket; values above the last
+    bound are counted in an overflow bucket.  Percentiles are estimated
+    from the bucket bounds.
+    """
+    metric_type = 'histogram'
+    percentiles = [50, 90, 99]
+    def __init__(self, name, buckets=None):
+        self.name = name
+        if buckets is None:
+            buckets = LATENCY_BUCKETS
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+    def time(self):
+        return HistogramTimer(self)
+    def get_percentile(self, pct, counts=None, total=None):
+        if counts is None:
+            counts = self.counts[:]
+            total = sum(counts)
+        if not total:
+            return 0.
+        target = total * pct / 100.
+        n = 0
+        for i, c in enumerate(counts):
+            n += c
+            if n >= target:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return self.max
+        return self.max
+    def get_value(self):
+        counts = self.counts[:]
+        total = sum(counts)
+        d = dict(
+            count=self.count,
+            sum=self.sum,
+            max=self.max,
+            buckets=zip(self.buckets + ['inf'], counts),
+        )
+        if total:
+            d['mean'] = self.sum / self.count
+        for pct in self.percentiles:
+            d['p%d' % (pct)] = self.get_percentile(pct, counts, total)
+        return d
+
+class HistogramTimer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.start)
+
+class MetricsRegistry(object):
+    """Collection of named metrics
+
+    Metrics are created (or fetched if they already exist) with
+    :meth:`counter`, :meth:`gauge` and :meth:`histogram`.
+    :meth:`snapshot` collects every value into a dict; counters also get a
+    per-second rate measured over at least ``rate_interval`` seconds.
+    """
+    def __init__(self, **kwargs):
+        self.rate_interval = float(kwargs.get('rate_interval', 10.))
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self._rate_samples = {}
+    def _get_metric(self, cls, name, **kwargs):
+        m = self.metrics.get(name)
+        if m is not None:
+            return m
+        with self.lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = self.metrics[name] = cls(name, **kwargs)
+        return m
+    def counter(self, name, func=None):
+        return self._get_metric(Counter, name, func=func)
+    def gauge(self, name, func=None):
+        return self._get_metric(Gauge, name, func=func)
+    def histogram(self, name, buckets=None):
+        return self._get_metric(Histogram, name, buckets=buckets)
+    def get_rate(self, name, value, now):
+        sample = self._rate_samples.get(name)
+        if sample is None:
+            self._rate_samples[name] = (now, value, 0.)
+            return 0.
+        t, last_value, rate = sample
+        if now - t >= self.rate_interval:
+            rate = (value - last_value) / (now - t)
+            self._rate_samples[name] = (now, value, rate)
+        return rate
+    def snapshot(self):
+        now = time.time()
+        d = {}
+        with self.lock:
+            metrics = self.metrics.items()
+        for name, m in sorted(metrics):
+            value = m.get_value()
+            if m.metric_type == 'counter':
+                value = dict(value=value, rate=self.get_rate(name, value, now))
+            d[name] = value
+        return d
+
+class StatsdPusher(threading.Thread):
+    """Periodically sends a registry's metrics to statsd over UDP
+
+    Counters are sent as deltas (``|c``), gauges as ``|g`` and histograms as
+    gauges of their count, mean and percentiles.
+    """
+    max_packet_size = 1400
+    def __init__(self, registry, **kwargs):
+        super(StatsdPusher, self).__init__()
+        self.daemon = True
+        self.registry = registry
+        self.address = (
+            kwargs.get('host', '127.0.0.1'),
+            int(kwargs.get('port', 8125)),
+        )
+        self.prefix = kwargs.get('prefix', 'udp_logger')
+        self.interval = float(kwargs.get('interval', 10.))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._last_counts = {}
+        self._stopped = threading.Event()
+    def build_lines(self):
+        lines = []
+        prefix = self.prefix
+        with self.registry.lock:
+            metrics = self.registry.metrics.items()
+        for name, m in sorted(metrics):
+            if prefix:
+                name = '.'.join([prefix, name])
+            if m.metric_type == 'counter':
+                value = m.get_value()
+                delta = value - self._last_counts.get(name, 0)
+                self._last_counts[name] = value
+                lines.append('%s:%d|c' % (name, delta))
+            elif m.metric_type == 'gauge':
+                lines.append('%s:%s|g' % (name, m.get_value()))
+            else:
+                value = m.get_value()
+                for key in ['count', 'mean', 'max'] + ['p%d' % (p) for p in m.percentiles]:
+                    if key in value:
+                        lines.append('%s.%s:%s|g' % (name, key, value[key]))
+        return lines
+    def push(self):
+        packet = []
+        size = 0
+        for line in self.build_lines():
+            if size + len(line) + 1 > self.max_packet_size and len(packet):
+                self.socket.sendto('\n'.join(packet), self.address)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if len(packet):
+            self.socket.sendto('\n'.join(packet), self.address)
+    def run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.interval)
+            try:
+                self.push()
+            except socket.error:
+                pass
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.socket.close()
@@ -0,0 +1,217 @@
+"""Filter and transform stages applied to batches of records before they are
+written to storage
+
+A pipeline is built from a list of stage definitions (dicts, or a JSON
+string of the list), each naming its stage type with ``stage``::
+
+    [
+        {"stage": "drop", "field": "x_event", "values": ["comment", "connect-pending"]},
+        {"stage": "drop", "field": "x_severity", "values": ["DEBUG"]},
+        {"stage": "keep", "field": "x_category", "values": ["session", "stream"]},
+        {"stage": "sample", "rate": 0.1, "key": ["c_client_id"]},
+        {"stage": "rewrite", "field": "x_sname", "pattern": "_[0-9]+p$", "replace": ""},
+        {"stage": "project", "fields": ["x_event", "x_app", "x_sname", "c_ip"]}
+    ]
+"""
+
+import re
+import json
+import zlib
+
+from wowza_ec2_bootstrapper.logstore import get_record_class
+
+def to_bytes(value):
+    """Encode a field value for hashing.  Received lines are byte strings
+    (not always ASCII) while stored records may hold unicode
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+class BaseStage(object):
+    __stage_abstract = True
+    stage_name = None
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._columns = {}
+    @classmethod
+    def create(cls, **kwargs):
+        stage_name = kwargs.get('stage')
+        def find_class(base_cls):
+            if getattr(base_cls, 'stage_name', None) == stage_name:
+                return base_cls
+            for _cls in base_cls.__subclasses__():
+                r = find_class(_cls)
+                if r is not None:
+                    return r
+            return None
+        stage_cls = find_class(BaseStage)
+        if stage_cls is None:
+            raise Exception('Could not locate pipeline stage %s' % (stage_name))
+        return stage_cls(**kwargs)
+    def get_column(self, fields, fname):
+        """Index of ``fname`` in a record layout (cached per layout), or
+        ``None`` if the layout does not have it
+        """
+        key = (fields, fname)
+        try:
+            return self._columns[key]
+        except KeyError:
+            pass
+        if fname in fields:
+            i = fields.index(fname)
+        else:
+            i = None
+        self._columns[key] = i
+        return i
+    def process(self, records):
+        raise NotImplementedError('must be defined in subclass')
+
+class DropStage(BaseStage):
+    """Remove records where ``field`` is one of ``values``"""
+    stage_name = 'drop'
+    keep_matching = False
+    def __init__(self, **kwargs):
+        super(DropStage, self).__init__(**kwargs)
+        self.field = kwargs['field']
+        values = kwargs['values']
+        if isinstance(values, basestring):
+            values = [values]
+        self.values = frozenset(values)
+    def process(self, records):
+        values = self.values
+        keep = self.keep_matching
+        result = []
+        for r in records:
+            i = self.get_column(r._fields, self.field)
+            matched = i is not None and r[i] in values
+            if matched is keep:
+                result.append(r)
+        return result
+
+class KeepStage(DropStage):
+    """Only keep records where ``field`` is one of ``values``"""
+    stage_name = 'keep'
+    keep_matching = True
+
+class ProjectStage(BaseStage):
+    """Reduce records to ``fields`` (``timestamp`` is always kept)"""
+    stage_name = 'project'
+    def __init__(self, **kwargs):
+        super(ProjectStage, self).__init__(**kwargs)
+        fields = kwargs['fields']
+        if isinstance(fields, basestring):
+            fields = fields.split(',')
+        if 'timestamp' not in fields:
+            fields = ['timestamp'] + list(fields)
+        self.fields = tuple(fields)
+        self._layouts = {}
+    def get_layout(self, fields):
+        layout = self._layouts.get(fields)
+        if layout is None:
+            names = [f for f in self.fields if f in fields]
+            layout = self._layouts[fields] = (
+                get_record_class(names), [fields.index(f) for f in names],
+            )
+        return layout
+    def process(self, records):
+        new = tuple.__new__
+        result = []
+        for r in records:
+            record_cls, columns = self.get_layout(r._fields)
+            result.append(new(record_cls, [r[i] for i in columns]))
+        return result
+
+class SampleStage(BaseStage):
+    """Keep a deterministic ``rate`` fraction of records
+
+    Records are selected by a hash of their ``key`` fields, so every record
+    for the same key (by default the client id) is either kept or dropped.
+    """
+    stage_name = 'sample'
+    resolution = 10000
+    def __init__(self, **kwargs):
+        super(SampleStage, self).__init__(**kwargs)
+        self.rate = float(kwargs.get('rate', 1.))
+        key = kwargs.get('key', ['c_client_id'])
+        if isinstance(key, basestring):
+            key = key.split(',')
+        self.key = key
+        self.threshold = int(self.rate * self.resolution)
+    def process(self, records):
+        result = []
+        threshold = self.threshold
+        resolution = self.resolution
+        for r in records:
+            values = []
+            for fname in self.key:
+                i = self.get_column(r._fields, fname)
+                values.append('' if i is None else to_bytes(r[i]))
+            h = zlib.crc32('\t'.join(values)) & 0xffffffff
+            if h % resolution < threshold:
+                result.append(r)
+        return result
+
+class RewriteStage(BaseStage):
+    """Rewrite the value of ``field``
+
+    Either ``pattern``/``replace`` (a regular expression substitution),
+    ``mapping`` (a dict of old to new values) or ``value`` (a constant).
+    """
+    stage_name = 'rewrite'
+    def __init__(self, **kwargs):
+        super(RewriteStage, self).__init__(**kwargs)
+        self.field = kwargs['field']
+        pattern = kwargs.get('pattern')
+        mapping = kwargs.get('mapping')
+        if pattern is not None:
+            regex = re.compile(pattern)
+            replace = kwargs.get('replace', '')
+            def rewrite(value):
+                if not isinstance(value, basestring):
+                    return value
+                return regex.sub(replace, value)
+        elif mapping is not None:
+            def rewrite(value):
+                return mapping.get(value, value)
+        elif 'value' in kwargs:
+            const = kwargs['value']
+            def rewrite(value):
+                return const
+        else:
+            raise ValueError('rewrite stage needs pattern, mapping or value')
+        self.rewrite = rewrite
+    def process(self, records):
+        new = tuple.__new__
+        rewrite = self.rewrite
+        result = []
+        for r in records:
+            i = self.get_column(r._fields, self.field)
+            if i is not None:
+                values = list(r)
+                values[i] = rewrite(values[i])
+                r = new(r.__class__, values)
+            result.append(r)
+        return result
+
+class Pipeline(object):
+    def __init__(self, stages=None):
+        if stages is None:
+            stages = []
+        elif isinstance(stages, basestring):
+            stages = json.loads(stages)
+        self.stages = []
+        for stage in stages:
+            if not isinstance(stage, BaseStage):
+                stage = BaseStage.create(**stage)
+            self.stages.append(stage)
+        self.records_in = 0
+        self.records_out = 0
+    def process(self, records):
+        self.records_in += len(records)
+        for stage in self.stages:
+            if not len(records):
+                break
+            records = stage.process(records)
+        self.records_out += len(records)
+        return records
@@ -0,0 +1,335 @@
+"""Additional destinations for records written by :class:`DbLogger`
+
+Each sink has its own bounded queue and worker thread, so a slow or
+unreachable destination only fills (and eventually drops from) its own
+queue and never blocks writes to the local store.  Sinks are built from a
+list of definitions (dicts, or a JSON string of the list), each naming its
+type with ``sink``::
+
+    [
+        {"sink": "forward", "protocol": "udp", "host": "10.0.0.5", "port": 8881},
+        {"sink": "forward", "protocol": "tcp", "host": "10.0.0.5", "port": 8883},
+        {"sink": "file", "path": "/usr/local/WowzaStreamingEngine/logs"},
+        {"sink": "store", "storage": "segment", "compress": true}
+    ]
+"""
+
+import os
+import json
+import time
+import socket
+import datetime
+import threading
+import traceback
+import collections
+
+from wowza_ec2_bootstrapper import logstore
+
+def format_line(record):
+    """Rebuild the tab-separated line Wowza sent for a record (without the
+    ``timestamp`` field added on receipt)
+    """
+    values = []
+    for fname, value in zip(record._fields, record):
+        if fname == 'timestamp':
+            continue
+        if value is None:
+            value = '-'
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        values.append(value)
+    return '\t'.join(values)
+
+class BaseSink(threading.Thread):
+    __sink_abstract = True
+    sink_name = None
+    # receive records as parsed, before any pipeline stages
+    raw_records = False
+    def __init__(self, **kwargs):
+        super(BaseSink, self).__init__()
+        self.daemon = True
+        self.kwargs = kwargs
+        self.name = kwargs.get('name', self.sink_name)
+        self.max_queue = int(kwargs.get('max_queue', 100000))
+        self.batch_size = int(kwargs.get('batch_size', 1000))
+        self.flush_interval = float(kwargs.get('flush_interval', 1.))
+        self.stop_timeout = float(kwargs.get('stop_timeout', 10.))
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.need_send = threading.Event()
+        self._running = threading.Event()
+        self._stopped = threading.Event()
+        self._stop_deadline = None
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+    @classmethod
+    def create(cls, **kwargs):
+        sink_name = kwargs.get('sink')
+        def find_class(base_cls):
+            if getattr(base_cls, 'sink_name', None) == sink_name:
+                return base_cls
+            for _cls in base_cls.__subclasses__():
+                r = find_class(_cls)
+                if r is not None:
+                    return r
+            return None
+        sink_cls = find_class(BaseSink)
+        if sink_cls is None:
+            raise Exception('Could not locate sink %s' % (sink_name))
+        return sink_cls(**kwargs)
+    def put(self, records):
+        with self.lock:
+            self.queue.extend(records)
+            excess = len(self.queue) - self.max_queue
+            if excess > 0:
+                for i in xrange(excess):
+                    self.queue.popleft()
+                self.dropped += excess
+            self.need_send.set()
+    def get_batch(self):
+        with self.lock:
+            n = min(len(self.queue), self.batch_size)
+            batch = [self.queue.popleft() for i in xrange(n)]
+            if not len(self.queue):
+                self.need_send.clear()
+        return batch
+    def requeue(self, batch):
+        with self.lock:
+            room = self.max_queue - len(self.queue)
+            if room < len(batch):
+                self.dropped += len(batch) - max(room, 0)
+                batch = batch[:max(room, 0)]
+            self.queue.extendleft(reversed(batch))
+    def run(self):
+        self._running.set()
+        errors = 0
+        while True:
+            if not self._running.is_set():
+                if not len(self.queue) or time.time() >= self._stop_deadline:
+                    break
+            else:
+                self.need_send.wait(self.flush_interval)
+            batch = self.get_batch()
+            try:
+                if len(batch):
+                    self.send(batch)
+                    self.sent += len(batch)
+                self.idle()
+                errors = 0
+            except Exception:
+                self.errors += 1
+                errors += 1
+                print('sink %s error\n%s' % (self.name, traceback.format_exc()))
+                self.requeue(batch)
+                self.reset()
+                if not self._running.is_set():
+                    break
+                time.sleep(min(2 ** (errors - 1), 30))
+        try:
+            self.close()
+        except Exception:
+            print(traceback.format_exc())
+        self._stopped.set()
+    def stop(self):
+        self._stop_deadline = time.time() + self.stop_timeout
+        self._running.clear()
+        self.need_send.set()
+        if self.is_alive():
+            self._stopped.wait()
+    def send(self, records):
+        raise NotImplementedError('must be defined in subclass')
+    def idle(self):
+        """Called after every pass of the worker loop for periodic work"""
+        pass
+    def reset(self):
+        """Called after a failed send to drop any connection state"""
+        pass
+    def close(self):
+        pass
+    def get_counters(self):
+        return dict(
+            sent=self.sent,
+            dropped=self.dropped,
+            errors=self.errors,
+            queue_depth=len(self.queue),
+        )
+
+class ForwardSink(BaseSink):
+    """Forward records to another udp_logger
+
+    With ``protocol='udp'`` lines are packed into datagrams of up to
+    ``max_datagram`` bytes (one line per ``\\n``).  With ``protocol='tcp'``
+    a persistent connection is kept and each batch is sent as newline
+    framed lines.
+
+    Records are forwarded as received, before any pipeline stages, so the
+    lines keep the full Wowza field layout the collector parses them with.
+    The receive ``timestamp`` is not sent: the collector stamps records
+    when they arrive, which may be later than the original receive time by
+    the sink's batching (``flush_interval``) and any retry delay.
+    """
+    sink_name = 'forward'
+    raw_records = True
+    def __init__(self, **kwargs):
+        super(ForwardSink, self).__init__(**kwargs)
+        self.protocol = kwargs.get('protocol', 'udp')
+        self.address = (kwargs['host'], int(kwargs.get('port', 8881)))
+        self.max_datagram = int(kwargs.get('max_datagram', 8192))
+        self.connect_timeout = float(kwargs.get('connect_timeout', 10.))
+        self.socket = None
+    def connect(self):
+        if self.socket is not None:
+            return self.socket
+        if self.protocol == 'tcp':
+            sock = socket.create_connection(self.address, self.connect_timeout)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket = sock
+        return sock
+    def send(self, records):
+        sock = self.connect()
+        lines = [format_line(r) + '\n' for r in records]
+        if self.protocol == 'tcp':
+            sock.sendall(''.join(lines))
+            return
+        packet = []
+        size = 0
+        for line in lines:
+            if size + len(line) > self.max_datagram and len(packet):
+                sock.sendto(''.join(packet), self.address)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line)
+        if len(packet):
+            sock.sendto(''.join(packet), self.address)
+    def reset(self):
+        self.close()
+    def close(self):
+        sock = self.socket
+        if sock is None:
+            return
+        self.socket = None
+        sock.close()
+
+class FileSink(BaseSink):
+    """Write records to rotated tab-separated ``.log`` files for the
+    :class:`LogSyncUp` action to upload
+
+    The current file is written in ``partial_path`` and moved into ``path``
+    once it is older than ``rotate_interval`` seconds or larger than
+    ``rotate_size`` bytes, so only complete files are ever synced.
+    """
+    sink_name = 'file'
+    def __init__(self, **kwargs):
+        super(FileSink, self).__init__(**kwargs)
+        self.path = os.path.expanduser(kwargs.get(
+            'path', '/usr/local/WowzaStreamingEngine/logs',
+        ))
+        partial_path = kwargs.get('partial_path')
+        if partial_path is None:
+            partial_path = '.'.join([self.path.rstrip('/'), 'partial'])
+        self.partial_path = os.path.expanduser(partial_path)
+        self.prefix = kwargs.get('prefix', 'wowzastreamingengine_udp')
+        self.rotate_interval = float(kwargs.get('rotate_interval', 3600.))
+        self.rotate_size = int(kwargs.get('rotate_size', 64 * 1024 * 1024))
+        self.fh = None
+        self.fields = None
+        self._filename = None
+        self._file_start = None
+        self._file_bytes = 0
+        self.recover_partial()
+    def recover_partial(self):
+        """Move files left in partial_path by a previous run into place"""
+        if not os.path.exists(self.partial_path):
+            return
+        for fn in os.listdir(self.partial_path):
+            self.move_complete(os.path.join(self.partial_path, fn))
+    def move_complete(self, filename):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        os.rename(filename, os.path.join(self.path, os.path.basename(filename)))
+    def open_file(self, fields):
+        if not os.path.exists(self.partial_path):
+            os.makedirs(self.partial_path)
+        now = datetime.datetime.utcnow()
+        fn = '%s.%s.log' % (self.prefix, now.strftime('%Y-%m-%d-%H%M%S-%f'))
+        fn = os.path.join(self.partial_path, fn)
+        header = '#Fields: %s\n' % (' '.join(f for f in fields if f != 'timestamp'))
+        self.fh = open(fn, 'ab')
+        self.fh.write(header)
+        self.fields = fields
+        self._filename = fn
+        self._file_start = time.time()
+        self._file_bytes = len(header)
+    def rotate(self):
+        fh = self.fh
+        if fh is None:
+            return
+        self.fh = None
+        fh.close()
+        self.move_complete(self._filename)
+    def send(self, records):
+        lines = []
+        for r in records:
+            if self.fh is not None and r._fields != self.fields:
+                self.fh.write(''.join(lines))
+                lines = []
+                self.rotate()
+            if self.fh is None:
+                self.open_file(r._fields)
+            lines.append(format_line(r) + '\n')
+        data = ''.join(lines)
+        self.fh.write(data)
+        self.fh.flush()
+        self._file_bytes += len(data)
+    def idle(self):
+        if self.fh is None:
+            return
+        if self._file_bytes >= self.rotate_size:
+            self.rotate()
+        elif time.time() - self._file_start >= self.rotate_interval:
+            self.rotate()
+    def close(self):
+        self.rotate()
+
+class StoreSink(BaseSink):
+    """Write records to an additional :mod:`logstore` backend.  Keyword
+    arguments are passed to :func:`logstore.build_store`
+    """
+    sink_name = 'store'
+    def __init__(self, **kwargs):
+        super(StoreSink, self).__init__(**kwargs)
+        store_kwargs = kwargs.copy()
+        store_kwargs.pop('sink', None)
+        self.store = logstore.build_store(**store_kwargs)
+    def send(self, records):
+        self.store.write_entries(records)
+    def idle(self):
+        self.store.check_flush()
+    def reset(self):
+        self.store.close()
+    def close(self):
+        self.store.close()
+
+def build_sinks(sinks, **defaults):
+    """Create sinks from a list of definitions.  Any ``defaults`` given are
+    used for keys a definition does not set
+    """
+    if isinstance(sinks, basestring):
+        sinks = json.loads(sinks)
+    result = []
+    names = set()
+    for i, sink in enumerate(sinks):
+        if not isinstance(sink, BaseSink):
+            sink_kwargs = defaults.copy()
+            sink_kwargs.update(sink)
+            sink = BaseSink.create(**sink_kwargs)
+        if sink.name in names:
+            sink.name = '%s%d' % (sink.name, i)
+        names.add(sink.name)
+        result.append(sink)
+    return result
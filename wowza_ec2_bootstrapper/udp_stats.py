@@ -0,0 +1,198 @@
+import time
+import threading
+import collections
+
+SESSION_START_EVENTS = set(['play', 'publish'])
+SESSION_END_EVENTS = set(['stop', 'unpublish', 'destroy', 'disconnect'])
+OTHER_STREAM = '_other_'
+
+# Indexes into the per-stream counter lists
+SC_BYTES, CS_BYTES, CONNECTS, DISCONNECTS, EVENTS = range(5)
+COUNTER_NAMES = ['sc_bytes', 'cs_bytes', 'connects', 'disconnects', 'events']
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+class StreamStats(object):
+    """Rolling per-app and per-stream counters computed from records as they
+    are ingested
+
+    Counters are kept in ``bucket_size`` second buckets covering the last
+    ``window`` seconds, so memory is bounded by the number of buckets times
+    the number of active streams (at most ``max_streams`` per bucket, extra
+    streams are counted under ``'_other_'``).  Byte counts are derived from
+    the cumulative ``sc_bytes``/``cs_bytes`` values Wowza reports for each
+    ``c_client_id``.  Current viewers are the sessions that have started
+    (play/publish) and not yet ended, up to ``max_sessions``; sessions with
+    no events for ``session_timeout`` seconds are expired.
+    """
+    def __init__(self, **kwargs):
+        self.window = float(kwargs.get('window', 300.))
+        self.bucket_size = float(kwargs.get('bucket_size', 10.))
+        self.max_streams = int(kwargs.get('max_streams', 1000))
+        self.max_sessions = int(kwargs.get('max_sessions', 100000))
+        self.session_timeout = float(kwargs.get('session_timeout', 3600.))
+        self.num_buckets = int(max(1, round(self.window / self.bucket_size)))
+        self.buckets = collections.deque()
+        self.clients = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.records_seen = 0
+    def get_bucket(self, ts):
+        start = ts // self.bucket_size * self.bucket_size
+        buckets = self.buckets
+        if len(buckets) and buckets[-1][0] >= start:
+            if buckets[-1][0] == start:
+                return buckets[-1][1]
+            for bucket_start, counters in reversed(buckets):
+                if bucket_start == start:
+                    return counters
+            # older than the window
+            return None
+        counters = {}
+        buckets.append((start, counters))
+        # buckets are not contiguous after a gap in traffic, so trim by time
+        cutoff = start - self.window
+        while len(buckets) > self.num_buckets or buckets[0][0] <= cutoff:
+            buckets.popleft()
+        return counters
+    def get_counters(self, bucket, app, stream):
+        key = (app, stream)
+        c = bucket.get(key)
+        if c is None:
+            if len(bucket) >= self.max_streams:
+                key = (app, OTHER_STREAM)
+                c = bucket.get(key)
+            if c is None:
+                c = bucket[key] = [0] * len(COUNTER_NAMES)
+        return c
+    def add_records(self, records):
+        if not len(records):
+            return
+        fields = records[0]._fields
+        def getter(fname):
+            if fname not in fields:
+                return lambda r: None
+            i = fields.index(fname)
+            return lambda r: r[i]
+        get_event = getter('x_event')
+        get_app = getter('x_app')
+        get_stream = getter('x_sname')
+        get_client = getter('c_client_id')
+        get_sc = getter('sc_bytes')
+        get_cs = getter('cs_bytes')
+        with self.lock:
+            for r in records:
+                if r._fields is not fields:
+                    # layout changed mid batch
+                    self._add_record(r)
+                    continue
+                self._add(
+                    r.timestamp, get_event(r), get_app(r), get_stream(r),
+                    get_client(r), get_sc(r), get_cs(r),
+                )
+            self.expire_sessions()
+    def _add_record(self, r):
+        self._add(
+            r.timestamp, getattr(r, 'x_event', None), getattr(r, 'x_app', None),
+            getattr(r, 'x_sname', None), getattr(r, 'c_client_id', None),
+            getattr(r, 'sc_bytes', None), getattr(r, 'cs_bytes', None),
+        )
+    def _add(self, ts, event, app, stream, client_id, sc_bytes, cs_bytes):
+        self.records_seen += 1
+        bucket = self.get_bucket(ts)
+        if bucket is None:
+            return
+        c = self.get_counters(bucket, app, stream)
+        c[EVENTS] += 1
+        if event == 'connect':
+            c[CONNECTS] += 1
+        elif event == 'disconnect':
+            c[DISCONNECTS] += 1
+        if client_id is None or client_id == '-':
+            return
+        sc_bytes = parse_int(sc_bytes)
+        cs_bytes = parse_int(cs_bytes)
+        key = (client_id, app, stream)
+        session = self.clients.pop(key, None)
+        if session is None:
+            session = [False, 0, 0, ts]
+        c[SC_BYTES] += max(sc_bytes - session[1], 0)
+        c[CS_BYTES] += max(cs_bytes - session[2], 0)
+        session[1] = sc_bytes
+        session[2] = cs_bytes
+        session[3] = ts
+        if event in SESSION_START_EVENTS:
+            session[0] = True
+        elif event in SESSION_END_EVENTS:
+            if event in ('destroy', 'disconnect'):
+                return
+            session[0] = False
+        # re-insert so self.clients stays ordered by last activity
+        self.clients[key] = session
+        while len(self.clients) > self.max_sessions:
+            self.clients.popitem(last=False)
+    def expire_sessions(self, now=None):
+        if now is None:
+            now = time.time()
+        clients = self.clients
+        while len(clients):
+            key, session = next(clients.iteritems())
+            if now - session[3] < self.session_timeout:
+                break
+            del clients[key]
+    def snapshot(self, now=None):
+        """Get the counters for the ``window`` seconds before ``now`` as a
+        dict of apps, each with totals and a dict of streams
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.window
+        with self.lock:
+            buckets = [b for b in self.buckets if b[0] > cutoff]
+            sessions = [(key, s[0]) for key, s in self.clients.iteritems()]
+            records_seen = self.records_seen
+        apps = {}
+        def get_app(app):
+            d = apps.get(app)
+            if d is None:
+                d = apps[app] = {'viewers':0, 'streams':{}}
+                d.update({name:0 for name in COUNTER_NAMES})
+            return d
+        def get_stream(app, stream):
+            streams = get_app(app)['streams']
+            d = streams.get(stream)
+            if d is None:
+                d = streams[stream] = {'viewers':0}
+                d.update({name:0 for name in COUNTER_NAMES})
+            return d
+        for bucket_start, bucket in buckets:
+            for (app, stream), c in bucket.items():
+                app_d = get_app(app)
+                stream_d = get_stream(app, stream)
+                for i, name in enumerate(COUNTER_NAMES):
+                    app_d[name] += c[i]
+                    stream_d[name] += c[i]
+        for (client_id, app, stream), active in sessions:
+            if not active:
+                continue
+            get_app(app)['viewers'] += 1
+            get_stream(app, stream)['viewers'] += 1
+        if len(buckets):
+            span = buckets[-1][0] + self.bucket_size - buckets[0][0]
+        else:
+            span = 0.
+        for app_d in apps.values():
+            for d in [app_d] + app_d['streams'].values():
+                if span:
+                    d['connect_rate'] = d['connects'] / span
+                    d['disconnect_rate'] = d['disconnects'] / span
+                else:
+                    d['connect_rate'] = d['disconnect_rate'] = 0.
+        return {
+            'window':span,
+            'records':records_seen,
+            'apps':apps,
+        }